@@ -0,0 +1,165 @@
+"""Calibrates inference configuration for the current host.
+
+Runs short timed predict trials over candidate batch sizes and TensorFlow
+intra/inter-op thread counts and stores the fastest configuration in
+base_dir/.host_profiles/<hostname>.json, see host_profile.py. Scoring and
+training scripts pick it up automatically.
+
+Thread pools can only be set before TensorFlow starts, so every trial runs in
+its own subprocess.
+
+The trial model is the embedding model of --collection_id if it was trained,
+otherwise EfficientNetB0 with the same head as train_model.py (random weights
+are as fast as trained ones). Inputs are random images.
+
+example run:
+python3 pixelscore_service/within_collection_score/calibrate.py
+  --base_dir=/mnt/disks/ssd/data
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from absl import app
+from absl import flags
+
+import host_profile
+
+# Image dimension for EfficientNet.
+EFFICIENTNET_IMAGE_SIZE = 224
+# Prefix of the trial result line printed by a trial subprocess.
+TRIAL_RESULT_PREFIX = 'TRIAL_RESULT '
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'collection_id',
+    '0x9a534628b4062e123ce7ee2222ec20b86e16ca8f',
+    'Collection id whose embedding model is used for trials if available.')
+flags.DEFINE_string(
+    'base_dir',
+    '/mnt/disks/ssd/data',
+    'Local base directory containing images.')
+flags.DEFINE_list(
+    'batch_sizes',
+    ['16', '32', '64', '128'],
+    'Candidate predict batch sizes.')
+flags.DEFINE_list(
+    'intra_op_threads',
+    [],
+    'Candidate intra-op thread counts, 0 is TensorFlow default. Defaults to 0, half and all cpus.')
+flags.DEFINE_list(
+    'inter_op_threads',
+    ['1', '2'],
+    'Candidate inter-op thread counts, 0 is TensorFlow default.')
+flags.DEFINE_integer(
+    'trial_examples',
+    256,
+    'Number of images predicted per trial.')
+# Flags of a single trial subprocess.
+flags.DEFINE_boolean(
+    'run_trial',
+    False,
+    'Internal, run a single trial with --trial_batch_size and thread counts.')
+flags.DEFINE_integer('trial_batch_size', 32, 'Internal, trial batch size.')
+flags.DEFINE_integer('trial_intra_op_threads', 0, 'Internal, trial intra-op threads.')
+flags.DEFINE_integer('trial_inter_op_threads', 0, 'Internal, trial inter-op threads.')
+
+
+def load_trial_model(base_dir, collection_id):
+    """Loads embedding model of the collection or an untrained one of the same architecture."""
+    import tensorflow as tf
+    model_path = base_dir + '/{}'.format(collection_id) + '/tf_logs/embedding_model'
+    if os.path.exists(model_path):
+        print('Using embedding model from {}'.format(model_path))
+        return tf.keras.models.load_model(model_path, compile=False)
+    base_model = tf.keras.applications.EfficientNetB0(
+        include_top=False,
+        input_shape=(EFFICIENTNET_IMAGE_SIZE, EFFICIENTNET_IMAGE_SIZE, 3),
+        weights=None)
+    return tf.keras.Sequential([
+        base_model,
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(1024, activation='relu'),
+        tf.keras.layers.Dense(512, activation='relu'),
+        tf.keras.layers.Dense(256, activation='relu'),
+        tf.keras.layers.Dense(128, activation='relu'),
+    ])
+
+
+def run_trial(base_dir, collection_id, batch_size, intra, inter, n_examples):
+    """Times predict in the current process and prints result line."""
+    host_profile.set_threads(intra, inter)
+    model = load_trial_model(base_dir, collection_id)
+    X_train = np.random.randint(
+        0, 256, size=(n_examples, EFFICIENTNET_IMAGE_SIZE,
+                      EFFICIENTNET_IMAGE_SIZE, 3), dtype=np.uint8)
+    # Warm up.
+    model.predict(X_train[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    model.predict(X_train, batch_size=batch_size)
+    images_per_second = n_examples / (time.perf_counter() - start)
+    print(TRIAL_RESULT_PREFIX + json.dumps({
+        'batch_size': batch_size,
+        'intra_op_threads': intra,
+        'inter_op_threads': inter,
+        'images_per_second': images_per_second}))
+
+
+def run_trial_subprocess(batch_size, intra, inter):
+    """Runs one trial in a fresh process, returns its result or None if it failed."""
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run_trial',
+        '--base_dir={}'.format(FLAGS.base_dir),
+        '--collection_id={}'.format(FLAGS.collection_id),
+        '--trial_examples={}'.format(FLAGS.trial_examples),
+        '--trial_batch_size={}'.format(batch_size),
+        '--trial_intra_op_threads={}'.format(intra),
+        '--trial_inter_op_threads={}'.format(inter)]
+    output = subprocess.run(
+        command, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    for line in output.splitlines():
+        if line.startswith(TRIAL_RESULT_PREFIX):
+            return json.loads(line[len(TRIAL_RESULT_PREFIX):])
+    print('Trial batch size {} threads {}/{} failed'.format(
+        batch_size, intra, inter))
+    return None
+
+
+def main(argv):
+    if FLAGS.run_trial:
+        run_trial(FLAGS.base_dir, FLAGS.collection_id, FLAGS.trial_batch_size,
+                  FLAGS.trial_intra_op_threads, FLAGS.trial_inter_op_threads,
+                  FLAGS.trial_examples)
+        return
+    n_cpus = os.cpu_count() or 1
+    intra_candidates = [int(n) for n in FLAGS.intra_op_threads] or \
+        sorted(set([0, max(1, n_cpus // 2), n_cpus]))
+    trials = []
+    for batch_size in [int(n) for n in FLAGS.batch_sizes]:
+        for intra in intra_candidates:
+            for inter in [int(n) for n in FLAGS.inter_op_threads]:
+                result = run_trial_subprocess(batch_size, intra, inter)
+                if result is None:
+                    continue
+                print('Batch size {}, intra/inter op threads {}/{}: {:.1f} images/s'.format(
+                    batch_size, intra, inter, result['images_per_second']))
+                trials.append(result)
+    if not trials:
+        raise RuntimeError('All calibration trials failed.')
+    best = max(trials, key=lambda trial: trial['images_per_second'])
+    profile = dict(best)
+    profile['calibrated_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    profile['trials'] = trials
+    host_profile.save_host_profile(FLAGS.base_dir, profile)
+    print('Best configuration: batch size {}, intra/inter op threads {}/{}, {:.1f} images/s'.format(
+        best['batch_size'], best['intra_op_threads'],
+        best['inter_op_threads'], best['images_per_second']))
+    print('Success')
+
+
+if __name__ == '__main__':
+    app.run(main)
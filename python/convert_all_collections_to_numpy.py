@@ -13,6 +13,8 @@ from absl import app
 from absl import flags
 import pandas as pd
 
+import profiling
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string(
@@ -34,10 +36,10 @@ flags.DEFINE_boolean(
 
 def main(argv):
     base_dir = FLAGS.base_dir
-    whitelist = os.listdir(base_dir)
+    whitelist = [f for f in os.listdir(base_dir) if not f.startswith('.')]
     for collection_id in whitelist:
       try:
-        os.system('python3 pixelscore_service/within_collection_score/img_to_numpy.py --collection_id={} --base_dir={}'.format(collection_id, base_dir))
+        os.system('python3 pixelscore_service/within_collection_score/img_to_numpy.py --collection_id={} --base_dir={}{}'.format(collection_id, base_dir, profiling.profile_flags()))
         print('Successfully computed pixelscores for collection {}'.format(collection_id))
       except:
         print('Unable to compute pixelscores for collection {}, trying next one'.format(collection_id))
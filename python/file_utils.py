@@ -0,0 +1,19 @@
+"""Helpers for moving files written in the current directory into base_dir.
+
+Scripts write output files to the current directory first and then move them
+into base_dir, which may be owned by root and mounted from another disk.
+"""
+
+import os
+import shutil
+
+
+def move_into_place(local_filename, filename):
+    """Moves file into place, with sudo only if the target dir is not writable.
+
+    Uses shutil.move, base_dir may be on another disk than the current directory.
+    """
+    if os.access(os.path.dirname(filename), os.W_OK):
+        shutil.move(local_filename, filename)
+    else:
+        os.system('sudo mv {} {}'.format(local_filename, filename))
@@ -0,0 +1,72 @@
+"""Per-host inference configuration found by calibrate.py.
+
+Stored in base_dir/.host_profiles/<hostname>.json with the predict batch size
+and TensorFlow intra/inter-op thread counts that gave the highest
+images/second on this host. Scoring and training scripts apply it at start,
+hosts without a profile keep TensorFlow defaults.
+"""
+
+import json
+import os
+import socket
+
+import file_utils
+
+PROFILES_DIR = '.host_profiles'
+
+
+def host_profile_path(base_dir, host=None):
+    """Returns path of the profile of host, defaults to the current host."""
+    return base_dir + '/{}/{}.json'.format(
+        PROFILES_DIR, host or socket.gethostname())
+
+
+def load_host_profile(base_dir):
+    """Loads profile of the current host, None if it was not calibrated."""
+    filename = host_profile_path(base_dir)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_host_profile(base_dir, profile):
+    """Saves profile of the current host."""
+    path = base_dir + '/' + PROFILES_DIR
+    if not os.path.exists(path):
+        os.system('sudo mkdir -p {}'.format(path))
+        os.system('sudo chmod ugo+rwx {}'.format(path))
+    filename = host_profile_path(base_dir)
+    with open('host_profile.json', 'w') as f:
+        json.dump(profile, f, indent=2)
+    print('Saving host profile to {}'.format(filename))
+    file_utils.move_into_place('host_profile.json', filename)
+    return True
+
+
+def set_threads(intra_op_threads, inter_op_threads):
+    """Sets TensorFlow thread pools, must be called before TensorFlow runs any op."""
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def apply_host_profile(base_dir):
+    """Applies thread settings of the current host profile.
+
+    Must be called before TensorFlow runs any op.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+
+    Returns:
+      batch_size: calibrated predict batch size, None if host was not calibrated.
+    """
+    profile = load_host_profile(base_dir)
+    if profile is None:
+        return None
+    set_threads(profile['intra_op_threads'], profile['inter_op_threads'])
+    print('Using host profile: batch size {}, intra/inter op threads {}/{}, calibrated at {:.1f} images/s'.format(
+        profile['batch_size'], profile['intra_op_threads'],
+        profile['inter_op_threads'], profile['images_per_second']))
+    return profile['batch_size']
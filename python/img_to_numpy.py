@@ -4,8 +4,13 @@ Reads images from base_dir/<collection_id>/resized and saves np arryas to
 base_dir/<collection_id>/numpy/pixels.npz
 base_dir/<collection_id>/numpy/labels.npz
 base_dir/<collection_id>/numpy/ids.npz
+base_dir/<collection_id>/numpy/frames.npz
 
-1) Converts images to numpy arrays
+Byte-identical images (e.g. unrevealed placeholders) are decoded and stored
+in pixels.npz only once, frames.npz maps every id to its row in pixels.npz.
+
+0) Updates base_dir/<collection_id>/manifest.csv, see manifest.py
+1) Converts images listed as valid in the manifest to numpy arrays
 2) Creates labels for them based on ground_truth rarityScore
 3) Saves results as np arrays
 
@@ -37,6 +42,10 @@ from tensorflow.keras.applications.efficientnet import preprocess_input, decode_
 from keras import backend as K
 from numpy import savez_compressed
 
+import file_utils
+import manifest
+import profiling
+
 # Global constants, don't touch them.
 # Default classes in pre-trained EfficientNet.
 N_CLASSES_STANDARD_MODEL = 1000
@@ -103,13 +112,15 @@ def load_labels(base_dir, collection_id, ids):
     return np.array(y_train)
 
 
-def save_pixels_numpy(base_dir, collection_id, X_train, ids):
+def save_pixels_numpy(base_dir, collection_id, X_train, ids, frame_index):
     """Saves nft collection pixels as archived numpy array.
 
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
       collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
-      X_train: np array with flattened pixels form entire collection e.g. [collection_length, 224 * 224]
+      X_train: np array with pixels of unique images e.g. [n_unique, 224, 224, 3]
+      ids: np array with local nft ids for the given collection e.g. [collection_length]
+      frame_index: np array with row of X_train for each id e.g. [collection_length]
     Returns:
       True if collection was saved as numpy.
     """
@@ -128,6 +139,12 @@ def save_pixels_numpy(base_dir, collection_id, X_train, ids):
     savez_compressed('ids.npz', ids)
     print('Saving ids as numpy to {}'.format(filename))
     os.system('sudo mv ids.npz {}'.format(filename))
+
+    # Save mapping from ids to unique frames.
+    filename = path + '/frames.npz'
+    savez_compressed('frames.npz', frame_index)
+    print('Saving frames as numpy to {}'.format(filename))
+    file_utils.move_into_place('frames.npz', filename)
     return True
 
 
@@ -167,44 +184,64 @@ def img_to_array(img_path):
 def collection_to_array(base_dir, collection_id):
     """Converts full colelction of images to np array.
 
+    Iterates over valid images of the collection manifest, files quarantined
+    by the manifest are skipped without decoding. Images with identical bytes
+    are decoded once and share one frame.
+
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
       collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
 
     Returns:
-      X_train: np array with flattened pixels form entire collection e.g. [collection_length, 224 * 224]
+      X_train: np array with pixels of unique images e.g. [n_unique, 224, 224, 3]
       ids: np array with local nft ids for the given collection e.g. [collection_length]
+      frame_index: np array with row of X_train for each id e.g. [collection_length]
     """
-    collection_folder = base_dir + '/{}'.format(collection_id) + '/resized'
+    df = manifest.valid_entries(
+        manifest.update_manifest(base_dir, collection_id))
     output_array = []
     ids = []
+    frame_index = []
+    # Content hash -> row in output_array.
+    frames = {}
     count = 0
-    for f in os.listdir(collection_folder):
-        path = collection_folder + '/{}'.format(f)
-        try:
-            image_array = img_to_array(path)
-            output_array.append(image_array)
-            ids.append(f)
-            print(len(output_array))
-        except BaseException:
-            print('Unable to load image from: {}, skipping'.format(path))
+    for path, f, content_hash in zip(
+            df['path'], df['id'], df['content_hash']):
+        if content_hash not in frames:
+            try:
+                image_array = img_to_array(path)
+                frames[content_hash] = len(output_array)
+                output_array.append(image_array)
+                print(len(output_array))
+            except Exception:
+                print('Unable to load image from: {}, skipping'.format(path))
+                count += 1
+                continue
+        ids.append(f)
+        frame_index.append(frames[content_hash])
         count += 1
         if count > MAX_EXAMPLES:
             break
     X_train = np.array(output_array)
-    print('Converted colelction of images to np array of shape '.format(X_train.shape))
-    return X_train, ids
+    print('Converted {} images with {} unique frames to np array of shape {}'.format(
+        len(ids), len(output_array), X_train.shape))
+    return X_train, ids, np.array(frame_index)
 
 
 def main(argv):
     if FLAGS.collection_id is not None:
         print('Generating Scres for collection {}'.format(FLAGS.collection_id))
-    X_train, ids = collection_to_array(
-        FLAGS.base_dir, FLAGS.collection_id)
-    save_pixels_numpy(FLAGS.base_dir, FLAGS.collection_id, X_train, ids)
+    with profiling.profile_stage(
+            FLAGS.base_dir, FLAGS.collection_id, 'decode'):
+        X_train, ids, frame_index = collection_to_array(
+            FLAGS.base_dir, FLAGS.collection_id)
+    save_pixels_numpy(
+        FLAGS.base_dir, FLAGS.collection_id, X_train, ids, frame_index)
     print('Converted images to numpy for collection {}'.format(
         FLAGS.collection_id))
-    y_train = load_labels(FLAGS.base_dir, FLAGS.collection_id, ids)
+    with profiling.profile_stage(
+            FLAGS.base_dir, FLAGS.collection_id, 'labels'):
+        y_train = load_labels(FLAGS.base_dir, FLAGS.collection_id, ids)
     save_labels_numpy(FLAGS.base_dir, FLAGS.collection_id, y_train, ids)
     print('Saved labels for collection {}'.format(
         FLAGS.collection_id))
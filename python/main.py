@@ -13,6 +13,18 @@ exchange.
 
 This script reads and writes all the data into FLAGS.base_dir.
 
+Outputs of all layers in --layer_names are obtained from one forward pass and
+saved to separate arrays, the layer in --score_layer is used for scoring.
+With --from_saved_layers scoring reuses previously saved layer outputs
+without running the network, e.g. to compare representations:
+python3 pixelscore_service/within_collection_score/main.py
+  --layer_names=global_average_pooling2d,dense_1,dense_2,dense_3
+python3 pixelscore_service/within_collection_score/main.py
+  --from_saved_layers --score_layer=dense_1
+Scores of a --score_layer other than the embedding layer are experimental and
+saved to pixelscore/pixelscore_<score_layer>.csv, production pixelscore.csv,
+delta and summary are left untouched.
+
 example run:
 python3 pixelscore_service/within_collection_score/main.py
   --collection_id='0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
@@ -26,10 +38,11 @@ import sklearn
 import scipy
 import tensorflow as tf
 from tensorflow import keras
-import matplotlib.pyplot as plt
 import os
 import gc
+import json
 import sys
+import tempfile
 import numpy as np
 from PIL import Image
 from absl import app
@@ -41,6 +54,16 @@ from sklearn.preprocessing import MinMaxScaler
 from tensorflow.keras.applications.efficientnet import preprocess_input, decode_predictions
 from keras import backend as K
 from numpy import savez_compressed
+from numpy.lib.format import open_memmap
+
+import file_utils
+import host_profile
+import manifest
+import model_version
+import neuron_sketch
+import profiling
+import score_delta
+import score_summary
 
 # Global constants, don't touch them.
 # Pixelscore will be scaled in (SCALING_MIN, SCALING_MAX)
@@ -54,6 +77,10 @@ MAX_EXAMPLES = 100000
 EFFICIENTNET_IMAGE_SIZE = 224
 # Number of bins for pixel rarity score, must be less than collection size.
 PIXEL_SCORE_BINS = 10
+# Layer whose output is used as the nft embedding for pixelscore.
+EMBEDDING_LAYER_NAME = 'dense_3'
+# Batch size for streaming layer output through the network.
+PREDICT_BATCH_SIZE = 64
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(
@@ -68,6 +95,38 @@ flags.DEFINE_boolean(
     'use_checkpoint',
     True,
     'Whether to use model checkpoint transfer learned for the given collection. If False, base EfficientNet with imagenet weights is used.')
+flags.DEFINE_boolean(
+    'use_student',
+    False,
+    'Whether to use distilled student model if its PixelScore rank agreement with the teacher passes student_min_agreement.')
+flags.DEFINE_float(
+    'student_min_agreement',
+    0.95,
+    'Min Spearman rank agreement of student and teacher PixelScores to use the student.')
+flags.DEFINE_list(
+    'layer_names',
+    [EMBEDDING_LAYER_NAME],
+    'Names of layers whose outputs are extracted in one forward pass and saved to numpy.')
+flags.DEFINE_string(
+    'score_layer',
+    EMBEDDING_LAYER_NAME,
+    'Name of layer whose output is binned into pixelscore.')
+flags.DEFINE_boolean(
+    'from_saved_layers',
+    False,
+    'Whether to score previously saved output of score_layer instead of running the model.')
+flags.DEFINE_boolean(
+    'streaming',
+    False,
+    'Whether to stream layer outputs batch by batch into per-neuron sketches instead of binning the full layer output matrix in memory.')
+flags.DEFINE_integer(
+    'num_shards',
+    1,
+    'Streaming mode only. If > 1, only shard_index of the collection is processed and scores are computed later by merge_shards.py.')
+flags.DEFINE_integer(
+    'shard_index',
+    0,
+    'Streaming mode only. Index of the collection shard processed by this worker.')
 
 
 def load_collection_numpy(base_dir, collection_id):
@@ -95,38 +154,120 @@ def load_collection_numpy(base_dir, collection_id):
     return X_train, ids
 
 
-def save_collection_numpy(base_dir, collection_id, X_train):
-    """Saves nft collection pixels as archived numpy array.
+def load_frame_index(base_dir, collection_id, n_ids):
+    """Loads row of pixels.npz for each id from base_dir/<collection_id>/numpy/frames.npz.
 
-    Saves to base_dir/<collection_id>/numpy/dnn_layers.npz
+    Identical images share one row of pixels.npz, see img_to_numpy.py.
+    Collections converted before frames.npz existed have one row per id.
 
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
       collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
-      X_train: np array with flattened pixels form entire collection e.g. [collection_length, 224 * 224]
+      n_ids: number of ids in the collection
+    Returns:
+      frame_index: np array with row of pixels for each id e.g. [collection_length]
+    """
+    filename = base_dir + '/{}'.format(collection_id) + '/numpy/frames.npz'
+    if not os.path.exists(filename):
+        return np.arange(n_ids)
+    frame_index = np.load(filename)['arr_0']
+    print('Loading frames as numpy from {}'.format(filename))
+    return frame_index
+
+
+def layer_filename(layer_name, extension='npz'):
+    """Returns numpy file name for layer output, dnn_layers.npz for the embedding layer.
+
+    Streaming mode saves .npy files that can be memory mapped.
+    """
+    if layer_name == EMBEDDING_LAYER_NAME:
+        return 'dnn_layers.{}'.format(extension)
+    return 'dnn_layers_{}.{}'.format(layer_name, extension)
+
+
+def score_filename(layer_name):
+    """Returns .csv file name for scores, pixelscore.csv for the embedding layer."""
+    if layer_name == EMBEDDING_LAYER_NAME:
+        return 'pixelscore.csv'
+    return 'pixelscore_{}.csv'.format(layer_name)
+
+
+def save_collection_numpy(base_dir, collection_id, X_train,
+                          layer_name=EMBEDDING_LAYER_NAME):
+    """Saves nft collection layer output as archived numpy array.
+
+    Saves to base_dir/<collection_id>/numpy/dnn_layers.npz for the embedding
+    layer and base_dir/<collection_id>/numpy/dnn_layers_<layer_name>.npz for
+    other layers.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      X_train: np array with layer output for entire collection e.g. [collection_length, 128]
+      layer_name: name of the layer X_train was obtained from
     Returns:
       True if collection was saved as numpy.
     """
     path = base_dir + '/{}'.format(collection_id) + '/numpy'
     if not os.path.exists(path):
         os.system('sudo mkdir {}'.format(path))
-    filename = path + '/dnn_layers.npz'
-    savez_compressed('dnn_layers.npz', X_train)
+    local_filename = layer_filename(layer_name)
+    filename = path + '/' + local_filename
+    savez_compressed(local_filename, X_train)
     print('Saving layers as numpy to {}'.format(filename))
-    os.system('sudo mv dnn_layers.npz {}'.format(filename))
+    os.system('sudo mv {} {}'.format(local_filename, filename))
     return True
 
 
-def save_collection_scores(base_dir, collection_id, df):
+def load_collection_layer(base_dir, collection_id, layer_name):
+    """Loads previously saved layer output and ids of the collection.
+
+    Loads the newer of the .npz saved by a regular run and the .npy saved by
+    a streaming run.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      layer_name: name of the layer to load
+    Returns:
+      X_train: np array with layer output, typically [collection_size, 128]
+      ids: np array with local nft ids for the given collection e.g. [collection_length]
+    """
+    path = base_dir + '/{}'.format(collection_id) + '/numpy'
+    filenames = [path + '/' + layer_filename(layer_name, extension)
+                 for extension in ['npz', 'npy']]
+    filenames = [f for f in filenames if os.path.exists(f)]
+    if not filenames:
+        raise FileNotFoundError(
+            'No saved output of layer {} in {}'.format(layer_name, path))
+    filename = max(filenames, key=os.path.getmtime)
+    if filename.endswith('.npy'):
+        X_train = np.load(filename)
+    else:
+        X_train = np.load(filename)['arr_0']
+    print('Loading layers as numpy from {}'.format(filename))
+    ids = np.load(path + '/ids.npz')['arr_0']
+    return X_train, ids
+
+
+def save_collection_scores(base_dir, collection_id, df,
+                           score_layer=EMBEDDING_LAYER_NAME):
     """Saves pixel scores for the given collection in .csv.
 
-    Saves to base_dir/<collection_id>/pixelscore/pixelscore.npz
-    Saves histogram to base_dir/<collection_id>/pixelscore/hist.png
+    Saves to base_dir/<collection_id>/pixelscore/pixelscore.csv
+    Saves changes since the previous run to base_dir/<collection_id>/pixelscore/delta.csv
+    Saves histogram and summary statistics to
+    base_dir/<collection_id>/pixelscore/hist.npz and summary.json, plots are
+    rendered separately by report.py.
+
+    Scores of any other layer than the embedding layer are only saved to
+    base_dir/<collection_id>/pixelscore/pixelscore_<score_layer>.csv
 
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
       collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
       df: dataframe with columns at least 'id' and 'PixelScore'
+      score_layer: name of the layer the scores were computed from
 
     Returns:
       True if collection was saved as numpy.
@@ -135,19 +276,19 @@ def save_collection_scores(base_dir, collection_id, df):
     path = base_dir + '/{}'.format(collection_id) + '/pixelscore'
     if not os.path.exists(path):
         os.system('sudo mkdir {}'.format(path))
-    filename = path + '/pixelscore.csv'
-    df.to_csv('pixelscore.csv')
-    print('Saving layers as numpy to {}'.format(filename))
-    os.system('sudo mv pixelscore.csv {}'.format(filename))
-    # Saev histogram.
-    filename = path + '/hist.png'
-    scores = df['PixelScore'].values
-    fig = plt.hist(scores, bins=28)
-    plt.title('Hist pixelscore')
-    plt.xlabel("pixelscore")
-    plt.ylabel("Frequency")
-    plt.savefig('hist.png')
-    os.system('sudo mv hist.png {}'.format(filename))
+    local_filename = score_filename(score_layer)
+    filename = path + '/' + local_filename
+    if score_layer != EMBEDDING_LAYER_NAME:
+        df.to_csv(local_filename)
+        print('Saving experimental scores of layer {} to {}'.format(
+            score_layer, filename))
+        file_utils.move_into_place(local_filename, filename)
+        return True
+    score_delta.save_delta(base_dir, collection_id, df)
+    df.to_csv(local_filename)
+    print('Saving scores to {}'.format(filename))
+    file_utils.move_into_place(local_filename, filename)
+    score_summary.save_score_summary(base_dir, collection_id, df)
     return True
 
 
@@ -164,25 +305,90 @@ def load_standard_model():
     return base_model
 
 
-def load_checkpoint(base_dir, collection_id):
+def load_checkpoint(base_dir, collection_id, layer_names=None):
     """Loads EfficientNet checkpoint, architecture may be modified from base.
 
-    Loads from base_dir/<collection_id>/tf_logs/model
+    Prefers the inference-only model from
+    base_dir/<collection_id>/tf_logs/embedding_model exported by train_model.py,
+    falls back to the full training model from
+    base_dir/<collection_id>/tf_logs/model if it is missing or does not
+    contain all layer_names.
 
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
       collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      layer_names: list of layer names the model must contain
 
     Returns:
       model: Keras model.
     """
-    model_path = base_dir + '/{}'.format(collection_id) + '/tf_logs/model'
+    tf_logs = base_dir + '/{}'.format(collection_id) + '/tf_logs'
+    embedding_model_path = tf_logs + '/embedding_model'
+    if os.path.exists(embedding_model_path):
+        print('Loading embedding model from {}'.format(embedding_model_path))
+        model = tf.keras.models.load_model(embedding_model_path, compile=False)
+        model_layers = [layer.name for layer in model.layers]
+        if all(name in model_layers for name in layer_names or []):
+            return model
+        print('Embedding model misses some of {}, loading full model.'.format(
+            layer_names))
+    model_path = tf_logs + '/model'
     model = tf.keras.models.load_model(model_path)
     # Check its architecture
     print(model.summary())
     return model
 
 
+def load_student(base_dir, collection_id, min_agreement):
+    """Loads distilled student model if it agrees well enough with the teacher.
+
+    Loads from base_dir/<collection_id>/tf_logs/student_model, see
+    train_model.py --distill. The student is ignored if the teacher was
+    retrained after it was distilled.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      min_agreement: min rank agreement from student_report.json
+
+    Returns:
+      model: Keras model, None if there is no student or agreement is too low.
+    """
+    tf_logs = base_dir + '/{}'.format(collection_id) + '/tf_logs'
+    report_path = tf_logs + '/student_report.json'
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path) as f:
+        report = json.load(f)
+    if report.get('teacher_mtime') != model_version.teacher_mtime(tf_logs):
+        print('Teacher was retrained after the student was distilled, using teacher.')
+        return None
+    if report['rank_agreement'] < min_agreement:
+        print('Student rank agreement {} below {}, using teacher.'.format(
+            report['rank_agreement'], min_agreement))
+        return None
+    print('Loading student model with rank agreement {} and speed-up {}'.format(
+        report['rank_agreement'], report['speedup']))
+    return tf.keras.models.load_model(tf_logs + '/student_model', compile=False)
+
+
+def get_embedding_model(model, layer_name=EMBEDDING_LAYER_NAME):
+    """Returns model whose output is the given layer, reusing model if it already ends there."""
+    if model.layers[-1].name == layer_name:
+        return model
+    return keras.models.Model(
+        inputs=model.input, outputs=model.get_layer(layer_name).output)
+
+
+def get_layers_model(model, layer_names):
+    """Returns model with one output per layer in layer_names."""
+    if len(layer_names) == 1:
+        return get_embedding_model(model, layer_names[0])
+    return keras.models.Model(
+        inputs=model.input,
+        outputs=[model.get_layer(name).output for name in layer_names])
+
+
 def get_layer_output_nft(img_path, model):
     """Gets DNN layer output for a given image, single raw image.
 
@@ -198,9 +404,7 @@ def get_layer_output_nft(img_path, model):
     img = img.convert('RGB')
     img_array = np.array(img)
     img_batch = np.expand_dims(img_array, axis=0)
-    layer_name = 'dense_3'
-    intermediate_layer_model = keras.models.Model(
-        inputs=model.input, outputs=model.get_layer(layer_name).output)
+    intermediate_layer_model = get_embedding_model(model)
     intermediate_output = intermediate_layer_model.predict(img_batch)
     layer_output = intermediate_output
     print('Obtained Layer output with shape: {}'.format(layer_output.shape))
@@ -212,7 +416,8 @@ def get_layer_output_nft(img_path, model):
 def get_layer_output_collection(base_dir, collection_id, model):
     """Gets DNN layer output for entire collection from raw images.
 
-    Reads from base_dir/<collection_id>/resized.
+    Reads from base_dir/<collection_id>/resized, images quarantined by the
+    collection manifest are skipped.
 
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
@@ -223,12 +428,14 @@ def get_layer_output_collection(base_dir, collection_id, model):
       X_train: np array with layer output, typically [collection_size, 128]
       ids: np array with local nft ids for the given collection e.g. [collection_length]
     """
-    collection_folder = base_dir + '/{}'.format(collection_id) + '/resized'
+    df = manifest.load_manifest(base_dir, collection_id)
+    if df is None:
+        df = manifest.update_manifest(base_dir, collection_id)
+    df = manifest.valid_entries(df)
     output_array = []
     ids = []
     count = 0
-    for f in os.listdir(collection_folder):
-        path = collection_folder + '/{}'.format(f)
+    for path, f in zip(df['path'], df['id']):
         layer_output = get_layer_output_nft(path, model).flatten()
         output_array.append(layer_output)
         ids.append(f)
@@ -242,35 +449,166 @@ def get_layer_output_collection(base_dir, collection_id, model):
     return X_train, ids
 
 
-def get_layer_output_collection_from_numpy(base_dir, collection_id, model):
+def get_layer_output_collection_from_numpy(
+        base_dir, collection_id, model, layer_names=None,
+        score_layer=EMBEDDING_LAYER_NAME, batch_size=None):
     """Gets DNN layer output for entire collection from previously saved numpy.
 
     Faster than getting layer from raw images.
     Reads from base_dir/<collection_id>/numpy/pixels.npz.
+    Outputs of all layer_names are obtained in one forward pass and each is
+    saved to its own numpy file, see save_collection_numpy.
 
     Args:
       base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
       collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
       model: Keras model
+      layer_names: list of layer names to extract, defaults to [score_layer]
+      score_layer: name of layer whose output is returned
+      batch_size: predict batch size, Keras default if None
 
     Returns:
-      layer_output: np array with layer output, typically [collection_size, 128]
+      layer_output: np array with output of score_layer, typically [collection_size, 128]
       ids: np array with local nft ids for the given collection e.g. [collection_length]
     """
+    layer_names = list(layer_names or [])
+    if score_layer not in layer_names:
+        layer_names.append(score_layer)
     X_train, ids = load_collection_numpy(base_dir, collection_id)
+    frame_index = load_frame_index(base_dir, collection_id, len(ids))
     # TODO(dstorcheus): If needed process layer outputs per batch.
-    print('Getting model layer output for the entire collection at once, takes a few mins.')
-    layer_name = 'dense_3'
-    intermediate_layer_model = keras.models.Model(
-        inputs=model.input, outputs=model.get_layer(layer_name).output)
-    intermediate_output = intermediate_layer_model.predict(X_train)
-    layer_output = intermediate_output
-    print('Obtained Layer output with shape: {}'.format(layer_output.shape))
+    print('Getting model layer output for {} unique images, takes a few mins.'.format(
+        len(X_train)))
+    intermediate_layer_model = get_layers_model(model, layer_names)
+    intermediate_output = intermediate_layer_model.predict(
+        X_train, batch_size=batch_size)
+    if len(layer_names) == 1:
+        intermediate_output = [intermediate_output]
+    for layer_name, output in zip(layer_names, intermediate_output):
+        # Fan out outputs of unique images to all ids.
+        output = output.reshape(len(output), -1)[frame_index]
+        print('Obtained {} output with shape: {}'.format(
+            layer_name, output.shape))
+        save_collection_numpy(base_dir, collection_id, output, layer_name)
+        if layer_name == score_layer:
+            layer_output = output
+    del intermediate_output
     gc.collect()
-    save_collection_numpy(base_dir, collection_id, layer_output)
     return layer_output, ids
 
 
+def get_layer_output_collection_streaming(
+        base_dir, collection_id, model, shard_index=0, num_shards=1,
+        score_layer=EMBEDDING_LAYER_NAME, batch_size=PREDICT_BATCH_SIZE):
+    """Streams DNN layer output batch by batch into a per-neuron sketch.
+
+    Layer outputs are written to disk as they come off the network, without
+    holding the full output matrix in memory. Each unique image is passed
+    through the network once and its output is fanned out to all ids sharing
+    it. Saves layer output to
+    base_dir/<collection_id>/numpy/dnn_layers.npy (named as layer_filename) and
+    sketch.npz, or dnn_layers.npy, ids.npz and sketch.npz to
+    base_dir/<collection_id>/numpy/shards/<shard_index> if num_shards > 1
+    together with shard.json recording shard_index, num_shards and score_layer,
+    checked by merge_shards.py.
+
+    Files are staged in a temporary directory of this process, so several
+    shard workers can run side by side from the same directory.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      model: Keras model
+      shard_index: index of the collection shard to process
+      num_shards: number of shards the collection is split into
+      score_layer: name of layer whose output is streamed
+      batch_size: number of unique images per predict batch
+
+    Returns:
+      sketch: neuron_sketch sketch of layer outputs
+      layer_path: path of the saved .npy layer output
+      ids: np array with local nft ids for the given shard
+    """
+    X_train, ids = load_collection_numpy(base_dir, collection_id)
+    frame_index = load_frame_index(base_dir, collection_id, len(ids))
+    shard = np.array_split(np.arange(len(ids)), num_shards)[shard_index]
+    ids = ids[shard]
+    # Unique frames of the shard, shard rows sorted by frame and the range of
+    # sorted rows for each frame.
+    frames, inverse = np.unique(frame_index[shard], return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(frames) + 1))
+    path = base_dir + '/{}'.format(collection_id) + '/numpy'
+    layer_file = layer_filename(score_layer, 'npy')
+    if num_shards > 1:
+        path = path + '/shards/{}'.format(shard_index)
+        layer_file = 'dnn_layers.npy'
+    if not os.path.exists(path):
+        os.system('sudo mkdir -p {}'.format(path))
+    intermediate_layer_model = get_embedding_model(model, score_layer)
+    n_neurons = int(np.prod(intermediate_layer_model.output_shape[1:]))
+    local_dir = tempfile.mkdtemp(
+        prefix='shard_{}_'.format(shard_index), dir='.')
+    layer_output = open_memmap(
+        local_dir + '/dnn_layers.npy', mode='w+', dtype=np.float32,
+        shape=(len(shard), n_neurons))
+    sketch = neuron_sketch.create_sketch(n_neurons)
+    print('Streaming layer output for {} nfts with {} unique images.'.format(
+        len(shard), len(frames)))
+    for start in range(0, len(frames), batch_size):
+        batch = frames[start:start + batch_size]
+        output = np.asarray(
+            intermediate_layer_model.predict_on_batch(X_train[batch])).reshape(
+                len(batch), -1)
+        rows = order[bounds[start]:bounds[start + len(batch)]]
+        output = output[inverse[rows] - start]
+        layer_output[rows] = output
+        neuron_sketch.update_sketch(sketch, output)
+    layer_output.flush()
+    del layer_output
+    gc.collect()
+    print('Saving layers as numpy to {}'.format(path + '/' + layer_file))
+    filenames = ['dnn_layers.npy', 'sketch.npz']
+    neuron_sketch.save_sketch(local_dir + '/sketch.npz', sketch)
+    if num_shards > 1:
+        savez_compressed(local_dir + '/ids.npz', ids)
+        with open(local_dir + '/shard.json', 'w') as f:
+            json.dump({'shard_index': shard_index, 'num_shards': num_shards,
+                       'num_ids': len(ids), 'score_layer': score_layer}, f)
+        filenames += ['ids.npz', 'shard.json']
+    for filename in filenames:
+        target = layer_file if filename == 'dnn_layers.npy' else filename
+        file_utils.move_into_place(
+            local_dir + '/' + filename, path + '/' + target)
+    os.rmdir(local_dir)
+    return sketch, path + '/' + layer_file, ids
+
+
+def get_scores_collection_streaming(sketch, layer_path, ids):
+    """Computes Pixelscores from sketch with a second pass over on-disk layer output.
+
+    Args:
+      sketch: neuron_sketch sketch of layer outputs
+      layer_path: path of .npy layer output
+      ids: np array local colelciton ids [colelction_size]
+
+    Returns:
+      df: Datafram with column 'PixelScore' and 'id'
+    """
+    print('Fitting bins to per-neuron sketches.')
+    edges = neuron_sketch.fit_bin_edges(sketch, PIXEL_SCORE_BINS)
+    X_train = np.load(layer_path, mmap_mode='r')
+    scores = neuron_sketch.score_embeddings(X_train, edges)
+    scores = neuron_sketch.scale_scores(
+        scores, PIXELSCORE_SCALING_MIN, PIXELSCORE_SCALING_MAX)
+    df = pd.DataFrame()
+    df['id'] = ids
+    df['PixelScore'] = scores
+    print('Head df with PixelScore')
+    print(df.head(10))
+    return df
+
+
 def get_scores_collection(X_train, ids):
     """Computes Pixelscores for a given collection from dnn layer neurons.
 
@@ -313,14 +651,56 @@ def get_scores_collection(X_train, ids):
 def main(argv):
     if FLAGS.collection_id is not None:
         print('Generating Scres for collection {}'.format(FLAGS.collection_id))
-    if FLAGS.use_checkpoint:
-        model = load_checkpoint(FLAGS.base_dir, FLAGS.collection_id)
-    else:
+    # Batch size and thread settings from calibrate.py, if this host has them.
+    batch_size = host_profile.apply_host_profile(FLAGS.base_dir)
+    layer_names = list(FLAGS.layer_names)
+    if FLAGS.score_layer not in layer_names:
+        layer_names.append(FLAGS.score_layer)
+    if FLAGS.from_saved_layers:
+        X_train, ids = load_collection_layer(
+            FLAGS.base_dir, FLAGS.collection_id, FLAGS.score_layer)
+        with profiling.profile_stage(
+                FLAGS.base_dir, FLAGS.collection_id, 'binning'):
+            df = get_scores_collection(X_train, ids)
+        save_collection_scores(
+            FLAGS.base_dir, FLAGS.collection_id, df, FLAGS.score_layer)
+        print('Success')
+        return
+    model = None
+    if FLAGS.use_student and layer_names == [EMBEDDING_LAYER_NAME]:
+        model = load_student(
+            FLAGS.base_dir, FLAGS.collection_id, FLAGS.student_min_agreement)
+    if model is None and FLAGS.use_checkpoint:
+        model = load_checkpoint(
+            FLAGS.base_dir, FLAGS.collection_id, layer_names)
+    elif model is None:
         model = load_standard_model()
-    X_train, ids = get_layer_output_collection_from_numpy(
-        FLAGS.base_dir, FLAGS.collection_id, model)
-    df = get_scores_collection(X_train, ids)
-    save_collection_scores(FLAGS.base_dir, FLAGS.collection_id, df)
+    if FLAGS.streaming:
+        with profiling.profile_stage(
+                FLAGS.base_dir, FLAGS.collection_id, 'predict'):
+            sketch, layer_path, ids = get_layer_output_collection_streaming(
+                FLAGS.base_dir, FLAGS.collection_id, model,
+                FLAGS.shard_index, FLAGS.num_shards, FLAGS.score_layer,
+                batch_size or PREDICT_BATCH_SIZE)
+        if FLAGS.num_shards > 1:
+            print('Saved shard {} of collection {}, run merge_shards.py once all shards are done'.format(
+                FLAGS.shard_index, FLAGS.collection_id))
+            print('Success')
+            return
+        with profiling.profile_stage(
+                FLAGS.base_dir, FLAGS.collection_id, 'binning'):
+            df = get_scores_collection_streaming(sketch, layer_path, ids)
+    else:
+        with profiling.profile_stage(
+                FLAGS.base_dir, FLAGS.collection_id, 'predict'):
+            X_train, ids = get_layer_output_collection_from_numpy(
+                FLAGS.base_dir, FLAGS.collection_id, model,
+                layer_names, FLAGS.score_layer, batch_size)
+        with profiling.profile_stage(
+                FLAGS.base_dir, FLAGS.collection_id, 'binning'):
+            df = get_scores_collection(X_train, ids)
+    save_collection_scores(
+        FLAGS.base_dir, FLAGS.collection_id, df, FLAGS.score_layer)
     print(
         'Completed Score generation for collection {}'.format(
             FLAGS.collection_id))
@@ -0,0 +1,141 @@
+"""Per-collection image manifest.
+
+Scans base_dir/<collection_id>/resized once with os.scandir and records for
+every file its path, nft id, size, mtime, whether its header looks like an
+image, whether it decodes and a hash of its bytes. Saved to
+base_dir/<collection_id>/manifest.csv
+
+When the manifest is updated, files with unchanged size and mtime keep their
+previous header and decode status, so corrupt or non-image files are decoded
+only once. Downstream stages iterate over valid entries of the manifest
+instead of listing and decoding the directory, quarantined files are excluded
+up front.
+"""
+
+import hashlib
+import os
+import pandas as pd
+from PIL import Image
+
+import file_utils
+
+MANIFEST_COLUMNS = ['path', 'id', 'size', 'mtime', 'header_ok', 'decode_ok',
+                    'content_hash']
+# Magic bytes of image formats found in collections.
+IMAGE_SIGNATURES = [
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',
+]
+
+
+def check_header(path):
+    """Returns True if file starts with a known image signature."""
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return True
+    return any(header.startswith(signature) for signature in IMAGE_SIGNATURES)
+
+
+def content_hash(path):
+    """Returns hash of file bytes, identical images have the same hash."""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def check_decode(path):
+    """Returns True if image fully decodes."""
+    try:
+        with Image.open(path) as img:
+            img.load()
+        return True
+    except Exception:
+        return False
+
+
+def manifest_path(base_dir, collection_id):
+    """Returns path to the manifest of the given collection."""
+    return base_dir + '/{}'.format(collection_id) + '/manifest.csv'
+
+
+def load_manifest(base_dir, collection_id):
+    """Loads manifest from base_dir/<collection_id>/manifest.csv, None if missing.
+
+    Paths are rebuilt from base_dir, so a manifest stays valid when base_dir
+    is mounted at another path, e.g. on another node.
+    """
+    filename = manifest_path(base_dir, collection_id)
+    if not os.path.exists(filename):
+        return None
+    print('Loading manifest from {}'.format(filename))
+    df = pd.read_csv(filename, dtype={'id': str})
+    collection_folder = base_dir + '/{}'.format(collection_id) + '/resized'
+    df['path'] = collection_folder + '/' + df['id']
+    return df
+
+
+def save_manifest(base_dir, collection_id, df):
+    """Saves manifest to base_dir/<collection_id>/manifest.csv."""
+    filename = manifest_path(base_dir, collection_id)
+    df.to_csv('manifest.csv', index=False)
+    print('Saving manifest to {}'.format(filename))
+    file_utils.move_into_place('manifest.csv', filename)
+    return True
+
+
+def update_manifest(base_dir, collection_id):
+    """Scans resized images and updates the manifest of the given collection.
+
+    Only new files and files whose size or mtime changed since the previous
+    manifest are checked. Entries are matched by file name, the manifest is
+    saved only if a file was checked or removed.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+
+    Returns:
+      df: manifest dataframe with MANIFEST_COLUMNS
+    """
+    collection_folder = base_dir + '/{}'.format(collection_id) + '/resized'
+    previous = load_manifest(base_dir, collection_id)
+    known = {}
+    if previous is not None:
+        for row in previous.itertuples(index=False):
+            known[row.id] = row
+    rows = []
+    n_checked = 0
+    with os.scandir(collection_folder) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            row = known.pop(entry.name, None)
+            if (row is not None and row.size == stat.st_size
+                    and row.mtime == stat.st_mtime_ns
+                    and isinstance(getattr(row, 'content_hash', None), str)):
+                rows.append(tuple(row._replace(path=entry.path)))
+                continue
+            header_ok = check_header(entry.path)
+            decode_ok = header_ok and check_decode(entry.path)
+            n_checked += 1
+            rows.append((entry.path, entry.name, stat.st_size,
+                         stat.st_mtime_ns, header_ok, decode_ok,
+                         content_hash(entry.path)))
+    df = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    n_quarantined = int((~(df['header_ok'] & df['decode_ok'])).sum())
+    # Files left in known were removed since the previous manifest.
+    n_removed = len(known)
+    print('Manifest has {} files, checked {}, removed {}, quarantined {}'.format(
+        len(df), n_checked, n_removed, n_quarantined))
+    if previous is None or n_checked > 0 or n_removed > 0:
+        save_manifest(base_dir, collection_id, df)
+    return df
+
+
+def valid_entries(df):
+    """Returns manifest rows of files that passed header and decode checks."""
+    return df[df['header_ok'] & df['decode_ok']]
@@ -0,0 +1,205 @@
+"""Merges per-shard sketches and computes Pixelscores for a single NFT collection.
+
+Shards are produced by running main.py in streaming mode on several workers:
+python3 pixelscore_service/within_collection_score/main.py --streaming
+  --num_shards=4 --shard_index=<0..3> --collection_id=...
+
+Each shard saves its layer outputs, ids and per-neuron sketch to
+base_dir/<collection_id>/numpy/shards/<shard_index>. This script merges all
+shard sketches into one collection-level sketch, fits bins on it and assigns
+Pixelscores in a second pass over the on-disk layer outputs of every shard.
+
+Exactly shards 0..num_shards-1 of one sharding are merged, num_shards is read
+from shard.json of shard 0 unless given by --num_shards. Fails if a shard is
+missing, belongs to a different sharding or the shard ids do not add up to the
+collection, stale shards of an earlier sharding with more shards are skipped.
+
+Saves scores to base_dir/<collection_id>/pixelscore/pixelscore.csv, or only to
+pixelscore_<score_layer>.csv if shards were streamed from another layer than
+the embedding layer.
+
+example run:
+python3 pixelscore_service/within_collection_score/merge_shards.py
+  --collection_id='0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+  --base_dir=/mnt/disks/ssd/data
+
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from absl import app
+from absl import flags
+
+import file_utils
+import neuron_sketch
+import profiling
+import score_delta
+import score_summary
+
+# Global constants, must match main.py.
+# Pixelscore will be scaled in (SCALING_MIN, SCALING_MAX)
+PIXELSCORE_SCALING_MIN = 0.0
+PIXELSCORE_SCALING_MAX = 10.0
+# Number of bins for pixel rarity score, must be less than collection size.
+PIXEL_SCORE_BINS = 10
+# Layer whose output is used as the nft embedding for pixelscore.
+EMBEDDING_LAYER_NAME = 'dense_3'
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'collection_id',
+    '0x9a534628b4062e123ce7ee2222ec20b86e16ca8f',
+    'Collection id.')
+flags.DEFINE_string(
+    'base_dir',
+    '/mnt/disks/ssd/data',
+    'Local base directory containing images.')
+flags.DEFINE_integer(
+    'num_shards',
+    0,
+    'Number of shards the collection was split into, 0 reads it from shard 0.')
+
+
+def load_shard_meta(shard_path):
+    """Loads shard.json saved by main.py with shard_index and num_shards."""
+    filename = shard_path + '/shard.json'
+    if not os.path.exists(filename):
+        raise ValueError('Shard {} is incomplete, missing {}'.format(
+            shard_path, filename))
+    with open(filename) as f:
+        return json.load(f)
+
+
+def list_shards(base_dir, collection_id, num_shards=0):
+    """Lists directories of shards 0..num_shards-1 of the current sharding.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      num_shards: number of shards, 0 reads it from shard.json of shard 0
+
+    Returns:
+      shard_paths: list of shard directories ordered by shard index
+      score_layer: name of the layer all shards were streamed from
+    """
+    path = base_dir + '/{}'.format(collection_id) + '/numpy'
+    if num_shards == 0:
+        num_shards = load_shard_meta(path + '/shards/0')['num_shards']
+    shard_paths = [path + '/shards/{}'.format(shard_index)
+                   for shard_index in range(num_shards)]
+    num_ids = 0
+    score_layers = set()
+    for shard_index, shard_path in enumerate(shard_paths):
+        meta = load_shard_meta(shard_path)
+        score_layers.add(meta.get('score_layer', EMBEDDING_LAYER_NAME))
+        if meta['shard_index'] != shard_index or meta['num_shards'] != num_shards:
+            raise ValueError(
+                'Shard {} was written as shard {} of {}, expected shard {} of {}'.format(
+                    shard_path, meta['shard_index'], meta['num_shards'],
+                    shard_index, num_shards))
+        num_ids += meta['num_ids']
+    if len(score_layers) > 1:
+        raise ValueError('Shards were streamed from different layers {}'.format(
+            sorted(score_layers)))
+    collection_ids = np.load(path + '/ids.npz')['arr_0']
+    if num_ids != len(collection_ids):
+        raise ValueError(
+            'Shards have {} ids but collection has {}, shards are stale'.format(
+                num_ids, len(collection_ids)))
+    stale = [shard for shard in os.listdir(path + '/shards')
+             if not shard.isdigit() or int(shard) >= num_shards]
+    if stale:
+        print('Skipping shards {} not part of {} shards'.format(
+            sorted(stale), num_shards))
+    return shard_paths, score_layers.pop()
+
+
+def merge_shards(shard_paths):
+    """Merges shard sketches and computes Pixelscores for all shards.
+
+    Args:
+      shard_paths: list of shard directories with dnn_layers.npy, ids.npz and sketch.npz
+
+    Returns:
+      df: Datafram with column 'PixelScore' and 'id'
+    """
+    sketches = [neuron_sketch.load_sketch(path + '/sketch.npz')
+                for path in shard_paths]
+    sketch = neuron_sketch.merge_sketches(sketches)
+    print('Fitting bins to merged sketch of {} shards.'.format(len(sketches)))
+    edges = neuron_sketch.fit_bin_edges(sketch, PIXEL_SCORE_BINS)
+    scores = []
+    ids = []
+    for path in shard_paths:
+        X_train = np.load(path + '/dnn_layers.npy', mmap_mode='r')
+        scores.append(neuron_sketch.score_embeddings(X_train, edges))
+        ids.append(np.load(path + '/ids.npz')['arr_0'])
+    scores = neuron_sketch.scale_scores(
+        np.concatenate(scores), PIXELSCORE_SCALING_MIN, PIXELSCORE_SCALING_MAX)
+    df = pd.DataFrame()
+    df['id'] = np.concatenate(ids)
+    df['PixelScore'] = scores
+    print('Head df with PixelScore')
+    print(df.head(10))
+    return df
+
+
+def save_collection_scores(base_dir, collection_id, df,
+                           score_layer=EMBEDDING_LAYER_NAME):
+    """Saves pixel scores for the given collection in .csv.
+
+    Saves to base_dir/<collection_id>/pixelscore/pixelscore.csv
+    Saves changes since the previous run to base_dir/<collection_id>/pixelscore/delta.csv
+    Saves histogram and summary statistics, see score_summary.py
+
+    Scores of any other layer than the embedding layer are only saved to
+    base_dir/<collection_id>/pixelscore/pixelscore_<score_layer>.csv
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      df: dataframe with columns at least 'id' and 'PixelScore'
+      score_layer: name of the layer the scores were computed from
+
+    Returns:
+      True if scores were saved.
+    """
+    path = base_dir + '/{}'.format(collection_id) + '/pixelscore'
+    if not os.path.exists(path):
+        os.system('sudo mkdir {}'.format(path))
+    if score_layer != EMBEDDING_LAYER_NAME:
+        filename = path + '/pixelscore_{}.csv'.format(score_layer)
+        df.to_csv('pixelscore.csv')
+        print('Saving experimental scores of layer {} to {}'.format(
+            score_layer, filename))
+        file_utils.move_into_place('pixelscore.csv', filename)
+        return True
+    score_delta.save_delta(base_dir, collection_id, df)
+    filename = path + '/pixelscore.csv'
+    df.to_csv('pixelscore.csv')
+    print('Saving scores to {}'.format(filename))
+    file_utils.move_into_place('pixelscore.csv', filename)
+    score_summary.save_score_summary(base_dir, collection_id, df)
+    return True
+
+
+def main(argv):
+    if FLAGS.collection_id is not None:
+        print('Merging shards for collection {}'.format(FLAGS.collection_id))
+    shard_paths, score_layer = list_shards(
+        FLAGS.base_dir, FLAGS.collection_id, FLAGS.num_shards)
+    with profiling.profile_stage(
+            FLAGS.base_dir, FLAGS.collection_id, 'binning'):
+        df = merge_shards(shard_paths)
+    save_collection_scores(
+        FLAGS.base_dir, FLAGS.collection_id, df, score_layer)
+    print(
+        'Completed Score generation for collection {}'.format(
+            FLAGS.collection_id))
+    print('Success')
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,17 @@
+"""Version of the trained model of a collection.
+
+train_model.py --distill records the version of the teacher in
+student_report.json and main.py --use_student compares it with the current
+one, so a student distilled from an older teacher is not used.
+"""
+
+import os
+
+
+def teacher_mtime(tf_logs):
+    """Returns mtime of the saved teacher model, changes whenever it is retrained."""
+    for name in ['embedding_model', 'model']:
+        filename = tf_logs + '/{}/saved_model.pb'.format(name)
+        if os.path.exists(filename):
+            return os.path.getmtime(filename)
+    return None
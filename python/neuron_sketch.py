@@ -0,0 +1,213 @@
+"""Mergeable per-neuron histogram sketches for streaming pixelscore.
+
+Instead of fitting KBinsDiscretizer on the full [collection_size, 128] matrix of
+DNN layer outputs, each neuron keeps a fixed size histogram over a symmetric
+range [-2^e, 2^e). When a value falls outside of the range, the range of that
+neuron is doubled and neighbouring histogram bins are collapsed. Since ranges
+are always powers of two, sketches built on different shards of a collection
+(possibly on different workers) can be merged exactly by bringing both to the
+larger range and adding the counts.
+
+Bins for pixelscore are then fitted with weighted 1D k-means on the histogram,
+same as KBinsDiscretizer(strategy='kmeans') does on raw values, and nfts are
+assigned to bins in a second pass over the on-disk layer outputs.
+
+A sketch is a dict of np arrays:
+  counts: [n_neurons, SKETCH_BINS] histogram counts
+  exponent: [n_neurons] histogram range is [-2^exponent, 2^exponent)
+  min: [n_neurons] smallest value seen
+  max: [n_neurons] largest value seen
+"""
+
+import numpy as np
+from numpy import savez_compressed
+
+# Number of fine histogram bins per neuron, must be divisible by 4.
+SKETCH_BINS = 2048
+# Max iterations of weighted k-means when fitting bin edges.
+KMEANS_MAX_ITER = 100
+# Smallest histogram range is [-2^MIN_EXPONENT, 2^MIN_EXPONENT).
+MIN_EXPONENT = -32
+# Bins narrower than this are dropped, same as KBinsDiscretizer.
+MIN_BIN_WIDTH = 1e-8
+
+
+def create_sketch(n_neurons):
+    """Creates empty sketch for n_neurons."""
+    return {
+        'counts': np.zeros((n_neurons, SKETCH_BINS), dtype=np.int64),
+        'exponent': np.zeros(n_neurons, dtype=np.int64),
+        'min': np.full(n_neurons, np.inf),
+        'max': np.full(n_neurons, -np.inf),
+    }
+
+
+def _double_range(sketch, rows):
+    """Doubles histogram range of given neurons collapsing pairs of bins."""
+    counts = sketch['counts'][rows]
+    collapsed = counts.reshape(len(rows), SKETCH_BINS // 2, 2).sum(axis=2)
+    counts = np.zeros_like(counts)
+    counts[:, SKETCH_BINS // 4: 3 * SKETCH_BINS // 4] = collapsed
+    sketch['counts'][rows] = counts
+    sketch['exponent'][rows] += 1
+
+
+def _is_empty(sketch):
+    """Returns mask of neurons without any values in the sketch."""
+    return sketch['counts'].sum(axis=1) == 0
+
+
+def _grow_to(sketch, exponent):
+    """Grows histogram ranges so that each neuron covers at least 2^exponent."""
+    # Empty neurons can take any range without collapsing bins.
+    empty = _is_empty(sketch)
+    sketch['exponent'][empty] = exponent[empty]
+    while True:
+        rows = np.flatnonzero(sketch['exponent'] < exponent)
+        if len(rows) == 0:
+            return sketch
+        _double_range(sketch, rows)
+
+
+def update_sketch(sketch, X_batch):
+    """Adds a batch of layer outputs to the sketch.
+
+    Args:
+      sketch: sketch dict from create_sketch
+      X_batch: np array DNN layer output [batch_size, n_neurons]
+
+    Returns:
+      sketch: updated sketch, modified in place
+    """
+    X_batch = np.asarray(X_batch, dtype=np.float64).reshape(
+        len(X_batch), -1)
+    if len(X_batch) == 0:
+        return sketch
+    max_abs = np.abs(X_batch).max(axis=0)
+    # Smallest exponent with max_abs < 2^exponent.
+    exponent = np.floor(np.log2(np.maximum(
+        max_abs, 2.0 ** (MIN_EXPONENT - 1)))).astype(np.int64) + 1
+    _grow_to(sketch, exponent)
+    radius = np.exp2(sketch['exponent'].astype(np.float64))
+    bins = np.floor((X_batch + radius) / (2 * radius) * SKETCH_BINS)
+    bins = np.clip(bins, 0, SKETCH_BINS - 1).astype(np.int64)
+    n_neurons = sketch['counts'].shape[0]
+    flat = bins + np.arange(n_neurons) * SKETCH_BINS
+    sketch['counts'] += np.bincount(
+        flat.ravel(), minlength=n_neurons * SKETCH_BINS).reshape(
+            n_neurons, SKETCH_BINS)
+    sketch['min'] = np.minimum(sketch['min'], X_batch.min(axis=0))
+    sketch['max'] = np.maximum(sketch['max'], X_batch.max(axis=0))
+    return sketch
+
+
+def merge_sketches(sketches):
+    """Merges list of sketches built on disjoint parts of one collection."""
+    merged = create_sketch(sketches[0]['counts'].shape[0])
+    for sketch in sketches:
+        other = {k: v.copy() for k, v in sketch.items()}
+        merged_empty = _is_empty(merged)
+        other_empty = _is_empty(other)
+        exponent = np.where(
+            merged_empty, other['exponent'],
+            np.where(other_empty, merged['exponent'],
+                     np.maximum(merged['exponent'], other['exponent'])))
+        _grow_to(merged, exponent)
+        _grow_to(other, exponent)
+        merged['counts'] += other['counts']
+        merged['min'] = np.minimum(merged['min'], other['min'])
+        merged['max'] = np.maximum(merged['max'], other['max'])
+    return merged
+
+
+def save_sketch(filename, sketch):
+    """Saves sketch as archived numpy arrays."""
+    savez_compressed(filename, **sketch)
+    print('Saving sketch as numpy to {}'.format(filename))
+    return True
+
+
+def load_sketch(filename):
+    """Loads sketch saved with save_sketch."""
+    data = np.load(filename)
+    print('Loading sketch as numpy from {}'.format(filename))
+    return {k: data[k] for k in ('counts', 'exponent', 'min', 'max')}
+
+
+def _kmeans_1d(values, weights, n_bins, col_min, col_max):
+    """Weighted 1D k-means initialized like KBinsDiscretizer, returns sorted centers."""
+    uniform_edges = np.linspace(col_min, col_max, n_bins + 1)
+    centers = (uniform_edges[1:] + uniform_edges[:-1]) * 0.5
+    for _ in range(KMEANS_MAX_ITER):
+        centers = np.sort(centers)
+        labels = np.searchsorted(
+            (centers[1:] + centers[:-1]) * 0.5, values, side='right')
+        total = np.bincount(labels, weights=weights, minlength=n_bins)
+        weighted = np.bincount(
+            labels, weights=weights * values, minlength=n_bins)
+        # Empty clusters keep their previous center.
+        new_centers = np.where(
+            total > 0, weighted / np.maximum(total, 1e-30), centers)
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    return np.sort(centers)
+
+
+def fit_bin_edges(sketch, n_bins):
+    """Fits per-neuron bin edges from sketch.
+
+    Args:
+      sketch: sketch dict
+      n_bins: number of pixelscore bins per neuron
+
+    Returns:
+      edges: np array [n_neurons, n_bins - 1] with inner bin edges per neuron,
+        padded with inf where bins were dropped.
+    """
+    n_neurons = sketch['counts'].shape[0]
+    edges = np.full((n_neurons, n_bins - 1), np.inf)
+    for j in range(n_neurons):
+        col_min, col_max = sketch['min'][j], sketch['max'][j]
+        if not col_max - col_min > 0:
+            # Constant neuron, everything goes into bin 0.
+            continue
+        radius = 2.0 ** sketch['exponent'][j]
+        width = 2 * radius / SKETCH_BINS
+        nonzero = np.flatnonzero(sketch['counts'][j])
+        values = np.clip(-radius + (nonzero + 0.5) * width, col_min, col_max)
+        weights = sketch['counts'][j][nonzero].astype(np.float64)
+        centers = _kmeans_1d(values, weights, n_bins, col_min, col_max)
+        bin_edges = np.concatenate(
+            [[col_min], (centers[1:] + centers[:-1]) * 0.5, [col_max]])
+        keep = np.ediff1d(bin_edges, to_begin=np.inf) > MIN_BIN_WIDTH
+        inner = bin_edges[keep][1:-1]
+        edges[j, :len(inner)] = inner
+    return edges
+
+
+def transform_bins(X_batch, edges):
+    """Assigns ordinal bins to a batch of layer outputs [batch_size, n_neurons]."""
+    Xt = np.empty(X_batch.shape, dtype=np.float64)
+    for j in range(edges.shape[0]):
+        Xt[:, j] = np.searchsorted(edges[j], X_batch[:, j], side='right')
+    return Xt
+
+
+def score_embeddings(X_train, edges, batch_size=4096):
+    """Computes unscaled pixelscores batch by batch, X_train may be np.memmap."""
+    scores = np.empty(len(X_train))
+    for start in range(0, len(X_train), batch_size):
+        X_batch = np.asarray(X_train[start:start + batch_size])
+        scores[start:start + len(X_batch)] = np.mean(
+            transform_bins(X_batch, edges), axis=1)
+    return scores
+
+
+def scale_scores(scores, scaling_min, scaling_max):
+    """Scales scores into (scaling_min, scaling_max), same as MinMaxScaler."""
+    score_range = scores.max() - scores.min()
+    if score_range == 0:
+        score_range = 1.0
+    return scaling_min + (scores - scores.min()) / score_range * (
+        scaling_max - scaling_min)
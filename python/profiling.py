@@ -0,0 +1,106 @@
+"""On-demand profiling of pipeline stages.
+
+img_to_numpy.py, train_model.py, main.py, merge_shards.py and the batch
+runners score_all_collections.py and convert_all_collections_to_numpy.py
+accept --profile_stages, a list of stage names to profile, e.g.
+--profile_stages=decode,predict. A profiled stage runs
+under cProfile and the TensorFlow profiler, both are bounded to the first
+--profile_max_seconds of the stage. Results are written to
+base_dir/<collection_id>/tf_logs/profile/<stage>-<timestamp>:
+python.prof - cProfile stats, open with pstats or snakeviz
+python.txt - top functions by cumulative time
+plugins/profile - TensorFlow trace, open with tensorboard --logdir
+
+Stages:
+  decode - img_to_numpy.py, images to numpy
+  labels - img_to_numpy.py, joining ground truth labels
+  train - train_model.py, training epochs
+  predict - main.py, layer output of the collection
+  binning - main.py, binning layer output into pixelscores
+"""
+
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import signal
+import time
+
+from absl import flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list(
+    'profile_stages',
+    [],
+    'Names of pipeline stages to profile with cProfile and TensorFlow profiler.')
+flags.DEFINE_integer(
+    'profile_max_seconds',
+    60,
+    'Max seconds of cProfile stats and TensorFlow trace captured per profiled stage, at least 1.',
+    lower_bound=1)
+
+# Number of functions listed in python.txt.
+TOP_FUNCTIONS = 50
+
+
+def profile_flags():
+    """Returns profiling flags to pass on to subprocess scripts."""
+    if not FLAGS.profile_stages:
+        return ''
+    return ' --profile_stages={} --profile_max_seconds={}'.format(
+        ','.join(FLAGS.profile_stages), FLAGS.profile_max_seconds)
+
+
+@contextlib.contextmanager
+def profile_stage(base_dir, collection_id, stage):
+    """Profiles the wrapped code if stage is in --profile_stages.
+
+    Profiling stops after --profile_max_seconds via SIGALRM, so it must be
+    used from the main thread.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      stage: name of the stage, see module docstring
+    """
+    if stage not in FLAGS.profile_stages:
+        yield
+        return
+    # Imported here so that batch runners forwarding the flags don't load TF.
+    import tensorflow as tf
+    path = base_dir + '/{}'.format(collection_id) + \
+        '/tf_logs/profile/{}-{}'.format(stage, time.strftime('%Y%m%d-%H%M%S'))
+    os.system('sudo mkdir -p {}'.format(path))
+    os.system('sudo chmod -R ugo+rwx {}'.format(path))
+    profiler = cProfile.Profile()
+    profiling = [True]
+
+    def stop_profiling(*args):
+        # cProfile only stops for the calling thread, the signal handler runs
+        # in the profiled main thread.
+        if profiling[0]:
+            profiler.disable()
+            tf.profiler.experimental.stop()
+            profiling[0] = False
+            print('Stopped profiling stage {} after {}s'.format(
+                stage, FLAGS.profile_max_seconds))
+
+    print('Profiling stage {} to {}'.format(stage, path))
+    previous_handler = signal.signal(signal.SIGALRM, stop_profiling)
+    tf.profiler.experimental.start(path)
+    signal.setitimer(signal.ITIMER_REAL, FLAGS.profile_max_seconds)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        stop_profiling()
+        profiler.dump_stats(path + '/python.prof')
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(
+            'cumulative').print_stats(TOP_FUNCTIONS)
+        with open(path + '/python.txt', 'w') as f:
+            f.write(stream.getvalue())
+        print('Saved profile of stage {} to {}'.format(stage, path))
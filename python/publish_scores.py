@@ -0,0 +1,268 @@
+"""Publishes pixelscores of a single NFT collection to the rankings store.
+
+Streams base_dir/<collection_id>/pixelscore/pixelscore.csv (or delta.csv with
+--use_delta, see score_delta.py) into write batches of --batch_size docs with
+up to --max_in_flight batches committed concurrently. Failed batches are
+retried with exponential backoff. Completed batches are checkpointed to
+base_dir/<collection_id>/pixelscore/publish_progress.json
+so an interrupted upload resumes where it stopped.
+
+Docs are merged into the rankings collection with the same doc ids as
+src/scripts/collectScores.ts: sha256 of '<chainId>::<collectionAddress>::<tokenId>'.
+
+Targets:
+  firestore - Firestore, requires google-cloud-firestore. Set --emulator_host
+    to write to a local Firestore emulator instead.
+  file - file-based stand-in, each batch is written as json lines to
+    --output_dir, useful for testing and throughput benchmarks.
+
+Tokens removed since the previous run (status 'removed' in delta.csv) get
+inCollectionPixelScore deleted from their doc, with firestore.DELETE_FIELD in
+Firestore and listed under 'delete_fields' in the file target.
+
+example run:
+python3 pixelscore_service/within_collection_score/publish_scores.py
+  --collection_id='0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+  --base_dir=/mnt/disks/ssd/data --target=file --output_dir=/tmp/publish
+
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from absl import app
+from absl import flags
+
+import file_utils
+
+# Same as src/utils/constants.ts.
+RANKINGS_COLL = 'rankings'
+CHAIN_ID = '1'
+# Firestore allows at most 500 writes per batch.
+MAX_BATCH_SIZE = 500
+# Save publishing progress every CHECKPOINT_EVERY completed batches.
+CHECKPOINT_EVERY = 10
+# Seconds to wait before the first retry, doubled on every attempt.
+RETRY_BACKOFF = 1.0
+# Marks a field to be deleted from the doc, translated by each writer.
+DELETE_FIELD = object()
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'collection_id',
+    '0x9a534628b4062e123ce7ee2222ec20b86e16ca8f',
+    'Collection id.')
+flags.DEFINE_string(
+    'base_dir',
+    '/mnt/disks/ssd/data',
+    'Local base directory containing images.')
+flags.DEFINE_enum(
+    'target',
+    'firestore',
+    ['firestore', 'file'],
+    'Where to publish scores.')
+flags.DEFINE_string(
+    'emulator_host',
+    '',
+    'host:port of local Firestore emulator, only for target firestore.')
+flags.DEFINE_string(
+    'output_dir',
+    '/tmp/publish_scores',
+    'Output directory for target file.')
+flags.DEFINE_boolean(
+    'use_delta',
+    False,
+    'Whether to publish only delta.csv of the last scoring run instead of all scores.')
+flags.DEFINE_integer(
+    'batch_size',
+    200,
+    'Number of docs per write batch.')
+flags.DEFINE_integer(
+    'max_in_flight',
+    4,
+    'Max number of write batches committed concurrently.')
+flags.DEFINE_integer(
+    'max_attempts',
+    5,
+    'Max commit attempts per batch.')
+
+
+def get_doc_id(chain_id, collection_address, token_id):
+    """Same as getDocIdHash in src/utils/main.ts."""
+    data = chain_id.strip() + '::' + collection_address.strip().lower() + \
+        '::' + token_id.strip()
+    return hashlib.sha256(data.encode('utf-8')).hexdigest().strip().lower()
+
+
+def iter_batches(filename, collection_id, batch_size):
+    """Streams scores from .csv as lists of (doc_id, data) of batch_size docs."""
+    for chunk in pd.read_csv(filename, dtype={'id': str}, chunksize=batch_size):
+        batch = []
+        # Only delta.csv has a status column.
+        if 'status' in chunk:
+            removed = (chunk['status'] == 'removed').values
+        else:
+            removed = np.zeros(len(chunk), dtype=bool)
+        for token_id, score, is_removed in zip(
+                chunk['id'], chunk['PixelScore'], removed):
+            data = {
+                'chainId': CHAIN_ID,
+                'collectionAddress': collection_id.strip().lower(),
+                'tokenId': token_id,
+                'inCollectionPixelScore': DELETE_FIELD if is_removed else float(score),
+            }
+            batch.append((get_doc_id(CHAIN_ID, collection_id, token_id), data))
+        yield batch
+
+
+def firestore_writer(emulator_host):
+    """Returns function committing one batch to Firestore."""
+    if emulator_host:
+        os.environ['FIRESTORE_EMULATOR_HOST'] = emulator_host
+    # Optional dependency, only needed for this target.
+    from google.cloud import firestore
+    client = firestore.Client()
+    rankings = client.collection(RANKINGS_COLL)
+
+    def commit(batch_index, batch):
+        write_batch = client.batch()
+        for doc_id, data in batch:
+            data = {key: firestore.DELETE_FIELD if value is DELETE_FIELD else value
+                    for key, value in data.items()}
+            write_batch.set(rankings.document(doc_id), data, merge=True)
+        write_batch.commit()
+
+    return commit
+
+
+def file_writer(output_dir):
+    """Returns function writing one batch as json lines to output_dir."""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    def commit(batch_index, batch):
+        filename = output_dir + '/batch_{:06d}.jsonl'.format(batch_index)
+        with open(filename, 'w') as f:
+            for doc_id, data in batch:
+                delete_fields = sorted(
+                    key for key, value in data.items() if value is DELETE_FIELD)
+                data = {key: value for key, value in data.items()
+                        if value is not DELETE_FIELD}
+                f.write(json.dumps({'doc_id': doc_id, 'data': data,
+                                    'delete_fields': delete_fields}) + '\n')
+
+    return commit
+
+
+def commit_with_retries(commit, batch_index, batch, max_attempts):
+    """Commits batch retrying with exponential backoff."""
+    for attempt in range(max_attempts):
+        try:
+            commit(batch_index, batch)
+            return batch_index
+        except Exception as e:
+            if attempt + 1 == max_attempts:
+                print('Failed to commit batch {}'.format(batch_index))
+                raise
+            print('Retrying batch {} after error: {}'.format(batch_index, e))
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+def load_progress(filename, source):
+    """Loads indices of completed batches if progress belongs to the same source."""
+    if not os.path.exists(filename):
+        return set()
+    with open(filename) as f:
+        progress = json.load(f)
+    if progress.get('source') != source:
+        print('Progress in {} is for another source, starting over'.format(
+            filename))
+        return set()
+    print('Resuming, {} batches already published'.format(
+        len(progress['completed'])))
+    return set(progress['completed'])
+
+
+def save_progress(filename, source, completed):
+    """Saves indices of completed batches."""
+    with open('publish_progress.json', 'w') as f:
+        json.dump({'source': source, 'completed': sorted(completed)}, f)
+    file_utils.move_into_place('publish_progress.json', filename)
+
+
+def publish(filename, collection_id, commit, progress_filename):
+    """Publishes all batches of the scores file.
+
+    Args:
+      filename: path to pixelscore.csv or delta.csv
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      commit: function(batch_index, batch) writing one batch
+      progress_filename: path to progress checkpoint
+
+    Returns:
+      n_docs: number of docs published in this run
+    """
+    # Batches are only comparable for the same file contents and batch size.
+    source = '{}:{}:{}'.format(
+        filename, os.path.getmtime(filename), FLAGS.batch_size)
+    completed = load_progress(progress_filename, source)
+    n_docs = 0
+    n_since_checkpoint = 0
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=FLAGS.max_in_flight) as executor:
+        try:
+            batches = iter_batches(filename, collection_id, FLAGS.batch_size)
+            for batch_index, batch in enumerate(batches):
+                if batch_index in completed:
+                    continue
+                if len(in_flight) >= FLAGS.max_in_flight:
+                    done, _ = concurrent.futures.wait(
+                        in_flight,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        completed.add(future.result())
+                        n_docs += in_flight.pop(future)
+                        n_since_checkpoint += 1
+                if n_since_checkpoint >= CHECKPOINT_EVERY:
+                    save_progress(progress_filename, source, completed)
+                    n_since_checkpoint = 0
+                future = executor.submit(
+                    commit_with_retries, commit, batch_index, batch,
+                    FLAGS.max_attempts)
+                in_flight[future] = len(batch)
+            for future in concurrent.futures.as_completed(in_flight):
+                completed.add(future.result())
+                n_docs += in_flight[future]
+        finally:
+            save_progress(progress_filename, source, completed)
+    return n_docs
+
+
+def main(argv):
+    if FLAGS.collection_id is not None:
+        print('Publishing scores for collection {}'.format(FLAGS.collection_id))
+    if FLAGS.batch_size > MAX_BATCH_SIZE:
+        raise app.UsageError('batch_size must be at most {}'.format(
+            MAX_BATCH_SIZE))
+    path = FLAGS.base_dir + '/{}'.format(FLAGS.collection_id) + '/pixelscore'
+    filename = path + ('/delta.csv' if FLAGS.use_delta else '/pixelscore.csv')
+    if FLAGS.target == 'firestore':
+        commit = firestore_writer(FLAGS.emulator_host)
+    else:
+        commit = file_writer(FLAGS.output_dir)
+    start = time.time()
+    n_docs = publish(filename, FLAGS.collection_id, commit,
+                     path + '/publish_progress.json')
+    elapsed = time.time() - start
+    print('Published {} docs in {:.1f}s, {:.1f} docs/s'.format(
+        n_docs, elapsed, n_docs / max(elapsed, 1e-9)))
+    print('Success')
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,100 @@
+"""Renders pixelscore report for all collections of a batch run.
+
+Reads histograms and summaries stored by scoring (see score_summary.py) and
+writes to --report_dir:
+<collection_id>_hist.png - histogram of pixelscores per collection
+summary.csv - summary statistics, one row per collection
+summary.png - mean and spread of pixelscore across collections
+
+example run:
+python3 pixelscore_service/within_collection_score/report.py
+  --base_dir=/mnt/disks/ssd/data --report_dir=/mnt/disks/ssd/report
+
+"""
+
+import os
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from absl import app
+from absl import flags
+
+import score_summary
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'collection_whitelist',
+    '',
+    'Path to .csv file with whitelist of collection_id')
+flags.DEFINE_boolean(
+    'use_whitelist',
+    False,
+    'Whether to use collections whitelist or report all colelctions found in base_dir.')
+flags.DEFINE_string(
+    'base_dir',
+    '/mnt/disks/ssd/data',
+    'Local base directory containing images.')
+flags.DEFINE_string(
+    'report_dir',
+    '/tmp/pixelscore_report',
+    'Directory the report is written to.')
+
+
+def plot_hist(filename, collection_id, counts, bin_edges):
+    """Plots stored histogram of one collection."""
+    fig, ax = plt.subplots()
+    ax.bar(bin_edges[:-1], counts, width=np.diff(bin_edges), align='edge')
+    ax.set_title('Hist pixelscore {}'.format(collection_id))
+    ax.set_xlabel('pixelscore')
+    ax.set_ylabel('Frequency')
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def plot_summary(filename, df):
+    """Plots median and 5-95 percentile range of pixelscore per collection."""
+    df = df.sort_values('p50')
+    fig, ax = plt.subplots(figsize=(max(6, len(df) * 0.1), 4))
+    x = np.arange(len(df))
+    ax.vlines(x, df['p5'], df['p95'], alpha=0.5)
+    ax.plot(x, df['p50'], '.')
+    ax.set_title('Pixelscore across {} collections'.format(len(df)))
+    ax.set_xlabel('collection, sorted by median')
+    ax.set_ylabel('pixelscore p5 / p50 / p95')
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def main(argv):
+    if FLAGS.use_whitelist:
+        df = pd.read_csv(FLAGS.collection_whitelist)
+        whitelist = df['colelction_id'].values
+    else:
+        whitelist = [f for f in os.listdir(FLAGS.base_dir)
+                     if not f.startswith('.')]
+    if not os.path.exists(FLAGS.report_dir):
+        os.makedirs(FLAGS.report_dir)
+    rows = []
+    for collection_id in whitelist:
+        loaded = score_summary.load_score_summary(FLAGS.base_dir, collection_id)
+        if loaded is None:
+            print('No scores for collection {}, skipping'.format(collection_id))
+            continue
+        counts, bin_edges, summary = loaded
+        plot_hist(FLAGS.report_dir + '/{}_hist.png'.format(collection_id),
+                  collection_id, counts, bin_edges)
+        summary['collection_id'] = collection_id
+        rows.append(summary)
+    df = pd.DataFrame(rows)
+    df.to_csv(FLAGS.report_dir + '/summary.csv', index=False)
+    if len(df):
+        plot_summary(FLAGS.report_dir + '/summary.png', df)
+    print('Saved report for {} collections to {}'.format(
+        len(df), FLAGS.report_dir))
+    print('Success')
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -6,8 +6,16 @@ imt_to_numpy.py -> train_model.py -> main.py
 Input:
 .csv file with collections whitelist, must have column 'colelction_id'
 
-example run:
+With --work_queue several nodes sharing the same base_dir split the work:
+each node claims collection/stage units through lease files under
+base_dir/.work_queue/<run_id> (see work_queue.py) and runs a stage only after
+the previous stage of the collection is done. Leases of dead nodes expire and
+are reclaimed, start the same command with the same --run_id on every node.
+A refresh run is started with a new --run_id.
 
+example run:
+python3 pixelscore_service/within_collection_score/score_all_collections.py
+  --base_dir=/mnt/disks/ssd/data --work_queue --run_id=2022-06-01
 
 """
 import os
@@ -18,6 +26,10 @@ from PIL import Image
 from absl import app
 from absl import flags
 import pandas as pd
+import time
+
+import profiling
+import work_queue
 
 FLAGS = flags.FLAGS
 
@@ -41,6 +53,87 @@ flags.DEFINE_boolean(
     'use_whitelist',
     False,
     'Whether to use collections whitelist or score all colelctions found in base_dir.')
+flags.DEFINE_boolean(
+    'work_queue',
+    False,
+    'Whether to claim collection/stage units through lease files shared with other nodes.')
+flags.DEFINE_string(
+    'run_id',
+    '',
+    'Id of the batch run shared by all nodes, required with --work_queue. Done and failed units are tracked per run.')
+flags.DEFINE_string(
+    'node_id',
+    '',
+    'Id of this node in the work queue, defaults to hostname and pid.')
+flags.DEFINE_integer(
+    'lease_ttl',
+    900,
+    'Seconds without heartbeat after which a lease is considered dead and reclaimed.')
+flags.DEFINE_integer(
+    'heartbeat_interval',
+    60,
+    'Seconds between lease heartbeats.')
+
+# Pipeline stages in order, each runs as a subprocess for one collection.
+STAGES = ['img_to_numpy', 'train_model', 'main']
+SCRIPTS_DIR = 'pixelscore_service/within_collection_score'
+# Seconds to wait before polling for claimable units again.
+POLL_INTERVAL = 30
+
+
+def stage_command(stage, collection_id, base_dir):
+    """Returns shell command running the given stage for one collection."""
+    return 'python3 {}/{}.py --collection_id={} --base_dir={}{}'.format(
+        SCRIPTS_DIR, stage, collection_id, base_dir,
+        profiling.profile_flags())
+
+
+def run_work_queue(base_dir, run_id, whitelist, node_id):
+    """Claims and runs collection/stage units until all of them are done or failed.
+
+    Args:
+      base_dir: Base data directory shared by all nodes e.g. /mnt/disks/ssd/data
+      run_id: id of the batch run shared by all nodes
+      whitelist: list of collection ids to score
+      node_id: id of this node
+    """
+    queue = work_queue.queue_dir(base_dir, run_id)
+    while True:
+        pending = False
+        claimed = False
+        for collection_id in whitelist:
+            for i, stage in enumerate(STAGES):
+                if work_queue.is_done(queue, collection_id, stage):
+                    continue
+                if work_queue.is_failed(queue, collection_id, stage):
+                    break
+                pending = True
+                if i > 0 and not work_queue.is_done(
+                        queue, collection_id, STAGES[i - 1]):
+                    break
+                lease = work_queue.try_acquire(
+                    queue, collection_id, stage, node_id, FLAGS.lease_ttl)
+                if lease is None:
+                    break
+                claimed = True
+                print('Node {} running {} for collection {}'.format(
+                    node_id, stage, collection_id))
+                stop = work_queue.start_heartbeat(
+                    lease, node_id, FLAGS.heartbeat_interval)
+                status = os.system(
+                    stage_command(stage, collection_id, base_dir))
+                stop.set()
+                work_queue.release(
+                    lease, queue, collection_id, stage, node_id, status == 0)
+                if status != 0:
+                    print('Stage {} failed for collection {}'.format(
+                        stage, collection_id))
+                    break
+        if not pending:
+            return
+        if not claimed:
+            # Remaining units are leased by other nodes or wait for them.
+            time.sleep(POLL_INTERVAL)
 
 def main(argv):
     if FLAGS.collection_whitelist is None:
@@ -49,13 +142,20 @@ def main(argv):
         df = pd.read_csv(FLAGS.collection_whitelist)
         whitelist = df['colelction_id'].values
     else:
-        whitelist = os.listdir(FLAGS.base_dir)
+        whitelist = [f for f in os.listdir(FLAGS.base_dir)
+                     if not f.startswith('.')]
+    if FLAGS.work_queue:
+        if not FLAGS.run_id:
+            raise ValueError('--run_id is required with --work_queue.')
+        node_id = FLAGS.node_id or work_queue.default_node_id()
+        run_work_queue(FLAGS.base_dir, FLAGS.run_id, whitelist, node_id)
+        print('Success')
+        return
     for collection_id in whitelist:
       print('Start computing pixelscores for collection {}'.format(collection_id))
       try:
-        os.system('python3 pixelscore_service/within_collection_score/img_to_numpy.py --collection_id={} --base_dir={}'.format(collection_id, FLAGS.base_dir))
-        os.system('python3 pixelscore_service/within_collection_score/train_model.py --collection_id={} --base_dir={}'.format(collection_id, FLAGS.base_dir))
-        os.system('python3 pixelscore_service/within_collection_score/main.py --collection_id={} --base_dir={}'.format(collection_id, FLAGS.base_dir))
+        for stage in STAGES:
+          os.system(stage_command(stage, collection_id, FLAGS.base_dir))
       except:
         print('Unable to compute pixelscores for collection {}, trying next one'.format(collection_id))
        
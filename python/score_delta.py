@@ -0,0 +1,113 @@
+"""Delta of pixelscores between two runs.
+
+Before new scores overwrite base_dir/<collection_id>/pixelscore/pixelscore.csv
+they are compared against the previous run and only tokens that were added,
+removed or whose PixelScore changed by more than --delta_tolerance are written
+to
+base_dir/<collection_id>/pixelscore/delta.csv
+with columns id, PixelScore (empty for removed tokens), status and run_id, so
+downstream publishing only has to upsert what actually changed. The run id and
+counts per status are also written to
+base_dir/<collection_id>/pixelscore/delta_meta.json
+so the run is recorded even if nothing changed.
+"""
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from absl import flags
+
+import file_utils
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float(
+    'delta_tolerance',
+    1e-3,
+    'Min absolute change of PixelScore for a token to be included in delta.csv.')
+
+DELTA_COLUMNS = ['id', 'PixelScore', 'status', 'run_id']
+
+
+def new_run_id():
+    """Returns identifier of the current scoring run."""
+    return time.strftime('%Y%m%d-%H%M%S')
+
+
+def load_previous_scores(base_dir, collection_id):
+    """Loads scores of the previous run, None if there are none."""
+    filename = base_dir + '/{}'.format(collection_id) + '/pixelscore/pixelscore.csv'
+    if not os.path.exists(filename):
+        return None
+    print('Loading previous scores from {}'.format(filename))
+    return pd.read_csv(filename, index_col=0, dtype={'id': str})
+
+
+def compute_delta(previous, df, tolerance, run_id):
+    """Computes added, changed and removed tokens.
+
+    Args:
+      previous: dataframe with columns 'id' and 'PixelScore' of previous run, may be None
+      df: dataframe with columns 'id' and 'PixelScore' of current run
+      tolerance: min absolute PixelScore change to count as changed
+      run_id: identifier of the current run
+
+    Returns:
+      delta: dataframe with DELTA_COLUMNS
+    """
+    current = pd.DataFrame({
+        'id': df['id'].astype(str).values,
+        'PixelScore': np.ravel(df['PixelScore'].values)})
+    if previous is None:
+        previous = pd.DataFrame({'id': [], 'PixelScore': []})
+    previous = previous[['id', 'PixelScore']].astype({'id': str})
+    merged = current.merge(
+        previous, on='id', how='outer', suffixes=('', '_previous'),
+        indicator=True)
+    status = np.where(
+        merged['_merge'] == 'left_only', 'added',
+        np.where(merged['_merge'] == 'right_only', 'removed', ''))
+    changed = (merged['_merge'] == 'both') & (
+        (merged['PixelScore'] - merged['PixelScore_previous']).abs() > tolerance)
+    status = np.where(changed, 'changed', status)
+    merged['status'] = status
+    merged['run_id'] = run_id
+    delta = merged[merged['status'] != ''][DELTA_COLUMNS]
+    print('Delta for run {}: {} added, {} changed, {} removed'.format(
+        run_id, (delta['status'] == 'added').sum(),
+        (delta['status'] == 'changed').sum(),
+        (delta['status'] == 'removed').sum()))
+    return delta
+
+
+def save_delta(base_dir, collection_id, df):
+    """Compares df with previous scores and saves delta.csv and delta_meta.json.
+
+    Must be called before the new pixelscore.csv is saved.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      df: dataframe with columns at least 'id' and 'PixelScore'
+
+    Returns:
+      run_id: identifier of the current run
+    """
+    run_id = new_run_id()
+    previous = load_previous_scores(base_dir, collection_id)
+    delta = compute_delta(previous, df, FLAGS.delta_tolerance, run_id)
+    path = base_dir + '/{}'.format(collection_id) + '/pixelscore'
+    if not os.path.exists(path):
+        os.system('sudo mkdir {}'.format(path))
+    filename = path + '/delta.csv'
+    delta.to_csv('delta.csv', index=False)
+    print('Saving delta to {}'.format(filename))
+    file_utils.move_into_place('delta.csv', filename)
+    meta = {'run_id': run_id, 'n_scores': int(len(df))}
+    for status in ['added', 'changed', 'removed']:
+        meta['n_{}'.format(status)] = int((delta['status'] == status).sum())
+    with open('delta_meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    file_utils.move_into_place('delta_meta.json', path + '/delta_meta.json')
+    return run_id
@@ -0,0 +1,70 @@
+"""Histogram and summary statistics of pixelscores of one collection.
+
+Scoring stores only numbers, without importing or running matplotlib:
+base_dir/<collection_id>/pixelscore/hist.npz - counts and bin_edges
+base_dir/<collection_id>/pixelscore/summary.json - count, mean, std, min, max
+  and percentiles of PixelScore
+
+Plots are rendered for a whole batch run at once by report.py.
+"""
+
+import json
+import os
+import numpy as np
+from numpy import savez_compressed
+
+import file_utils
+
+# Number of histogram bins of pixelscore.
+HIST_BINS = 28
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+
+def summarize_scores(scores):
+    """Returns dict with summary statistics of scores."""
+    scores = np.ravel(np.asarray(scores, dtype=np.float64))
+    summary = {
+        'count': int(len(scores)),
+        'mean': float(np.mean(scores)),
+        'std': float(np.std(scores)),
+        'min': float(np.min(scores)),
+        'max': float(np.max(scores)),
+    }
+    for p, value in zip(PERCENTILES, np.percentile(scores, PERCENTILES)):
+        summary['p{}'.format(p)] = float(value)
+    return summary
+
+
+def save_score_summary(base_dir, collection_id, df):
+    """Saves histogram and summary statistics of df['PixelScore'].
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      df: dataframe with columns at least 'id' and 'PixelScore'
+
+    Returns:
+      summary: dict from summarize_scores
+    """
+    path = base_dir + '/{}'.format(collection_id) + '/pixelscore'
+    scores = np.ravel(df['PixelScore'].values)
+    counts, bin_edges = np.histogram(scores, bins=HIST_BINS)
+    savez_compressed('hist.npz', counts=counts, bin_edges=bin_edges)
+    print('Saving histogram to {}'.format(path + '/hist.npz'))
+    file_utils.move_into_place('hist.npz', path + '/hist.npz')
+    summary = summarize_scores(scores)
+    with open('summary.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    file_utils.move_into_place('summary.json', path + '/summary.json')
+    return summary
+
+
+def load_score_summary(base_dir, collection_id):
+    """Loads histogram and summary, None if the collection has not been scored."""
+    path = base_dir + '/{}'.format(collection_id) + '/pixelscore'
+    if not os.path.exists(path + '/summary.json'):
+        return None
+    hist = np.load(path + '/hist.npz')
+    with open(path + '/summary.json') as f:
+        summary = json.load(f)
+    return hist['counts'], hist['bin_edges'], summary
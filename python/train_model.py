@@ -13,6 +13,27 @@ base_dir/<collection_id>/tf_logs/model
 
 Writes intermediate training data into tf_logs as well.
 
+Saves inference-only model ending at the embedding layer, without softmax head
+and optimizer state, to
+base_dir/<collection_id>/tf_logs/embedding_model
+
+Saves ids of the tokens the checkpoint was trained on to
+base_dir/<collection_id>/tf_logs/trained_ids.npz
+
+With --distill a small student CNN is trained to reproduce the EMBEDDING_LAYER_NAME
+output of the trained checkpoint (teacher) and saved to
+base_dir/<collection_id>/tf_logs/student_model
+together with an evaluation report of inference speed-up and PixelScore rank
+agreement against the teacher in
+base_dir/<collection_id>/tf_logs/student_report.json
+The report records the mtime of the teacher, main.py ignores the student after
+the teacher is retrained until it is distilled again.
+
+With --incremental the existing checkpoint is loaded and fine-tuned only on
+tokens added since the last run plus a replay sample of already seen tokens,
+for a reduced number of epochs. Falls back to full training if no checkpoint
+or trained ids are found.
+
 example run:
 python3 pixelscore_service/within_collection_score/train_model.py
   --collection_id='0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
@@ -29,12 +50,15 @@ from tensorflow import keras
 import matplotlib.pyplot as plt
 import os
 import gc
+import json
 import sys
+import time
 import numpy as np
 from PIL import Image
 from absl import app
 from absl import flags
 
+from scipy.stats import spearmanr
 from sklearn.preprocessing import KBinsDiscretizer
 from keras.models import Sequential
 from keras.layers.core import Dense, Dropout, Activation, Flatten
@@ -43,6 +67,11 @@ from tensorflow.keras.applications.efficientnet import preprocess_input, decode_
 from keras import backend as K
 from numpy import savez_compressed
 
+import file_utils
+import host_profile
+import model_version
+import profiling
+
 # Functions for loading model and scoring one collection of NFTs.
 
 N_CLASSES = 10
@@ -60,6 +89,18 @@ PIXEL_SCORE_BINS = 10
 EPOCHS = 10
 BATCH_SIZE = 32
 LR = 0.001
+# Layer whose output is used as the nft embedding for pixelscore.
+EMBEDDING_LAYER_NAME = 'dense_3'
+# Params for incremental fine tuning of an existing checkpoint.
+INCREMENTAL_EPOCHS = 3
+INCREMENTAL_LR = 0.0001
+# Params for distilling teacher embeddings into a small student model.
+DISTILL_EPOCHS = 20
+DISTILL_LR = 0.001
+# Max number of nfts used to time teacher and student inference.
+EVAL_TIMING_EXAMPLES = 512
+# Fraction of unique images held out from distillation to measure rank agreement.
+DISTILL_HOLDOUT = 0.15
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(
@@ -78,6 +119,22 @@ flags.DEFINE_boolean(
     'use_checkpoint',
     False,
     'Whether to use model checkpoint transfer learned for the given collection. If False, base EfficientNet with imagenet weights is used.')
+flags.DEFINE_boolean(
+    'incremental',
+    False,
+    'Whether to fine tune existing checkpoint only on tokens added since it was trained plus a replay sample of old tokens.')
+flags.DEFINE_integer(
+    'incremental_epochs',
+    INCREMENTAL_EPOCHS,
+    'Number of epochs for incremental fine tuning.')
+flags.DEFINE_float(
+    'replay_ratio',
+    1.0,
+    'Number of replayed old tokens per new token in incremental mode.')
+flags.DEFINE_boolean(
+    'distill',
+    False,
+    'Whether to distill embeddings of the trained checkpoint into a small student model and evaluate it.')
 
 def tensorboard_callback(directory, name):
     """Tensorboard Callback."""
@@ -118,6 +175,27 @@ def load_collection_numpy(base_dir, collection_id):
     return X_train, ids
 
 
+def load_frame_index(base_dir, collection_id, n_ids):
+    """Loads row of pixels.npz for each id from base_dir/<collection_id>/numpy/frames.npz.
+
+    Identical images share one row of pixels.npz, see img_to_numpy.py.
+    Collections converted before frames.npz existed have one row per id.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      n_ids: number of ids in the collection
+    Returns:
+      frame_index: np array with row of pixels for each id e.g. [collection_length]
+    """
+    filename = base_dir + '/{}'.format(collection_id) + '/numpy/frames.npz'
+    if not os.path.exists(filename):
+        return np.arange(n_ids)
+    frame_index = np.load(filename)['arr_0']
+    print('Loading frames as numpy from {}'.format(filename))
+    return frame_index
+
+
 def load_labels(base_dir, collection_id, ids):
     """Loads labels based on ground-truth rarity.score for a specific nft collection.
 
@@ -135,6 +213,70 @@ def load_labels(base_dir, collection_id, ids):
     return y_train
 
 
+def load_trained_ids(base_dir, collection_id):
+    """Loads ids of the tokens the saved checkpoint was trained on.
+
+    Loads from base_dir/<collection_id>/tf_logs/trained_ids.npz
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+    Returns:
+      trained_ids: np array with local nft ids, None if checkpoint or ids are missing.
+    """
+    tf_logs = base_dir + '/{}'.format(collection_id) + '/tf_logs'
+    filename = tf_logs + '/trained_ids.npz'
+    if not os.path.exists(tf_logs + '/model') or not os.path.exists(filename):
+        return None
+    trained_ids = np.load(filename)['arr_0']
+    print('Loading trained ids as numpy from {}'.format(filename))
+    return trained_ids
+
+
+def save_trained_ids(base_dir, collection_id, ids):
+    """Saves ids of the tokens the checkpoint was trained on.
+
+    Saves to base_dir/<collection_id>/tf_logs/trained_ids.npz
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      ids: np array with local nft ids e.g. [collection_length]
+    Returns:
+      True if ids were saved as numpy.
+    """
+    tf_logs = base_dir + '/{}'.format(collection_id) + '/tf_logs'
+    filename = tf_logs + '/trained_ids.npz'
+    savez_compressed('trained_ids.npz', ids)
+    print('Saving trained ids as numpy to {}'.format(filename))
+    file_utils.move_into_place('trained_ids.npz', filename)
+    return True
+
+
+def select_incremental_examples(ids, trained_ids, replay_ratio):
+    """Selects new tokens plus a random replay sample of already trained tokens.
+
+    Args:
+      ids: np array with local nft ids for the entire collection e.g. [collection_length]
+      trained_ids: np array with ids the checkpoint was trained on
+      replay_ratio: number of replayed old tokens per new token
+
+    Returns:
+      indices: np array with indices into ids to fine tune on, empty if there
+        are no new tokens.
+    """
+    is_new = ~np.isin(ids, trained_ids)
+    new_indices = np.flatnonzero(is_new)
+    old_indices = np.flatnonzero(~is_new)
+    print('Found {} new and {} previously trained tokens.'.format(
+        len(new_indices), len(old_indices)))
+    if len(new_indices) == 0:
+        return new_indices
+    n_replay = min(len(old_indices), int(len(new_indices) * replay_ratio))
+    replay_indices = np.random.choice(old_indices, n_replay, replace=False)
+    return np.concatenate([new_indices, replay_indices])
+
+
 def save_collection_scores(base_dir, collection_id, df):
     """Saves pixel scores for the given collection in .csv.
 
@@ -188,6 +330,33 @@ def create_architecture_small_cnn():
     return model
 
 
+def create_architecture_student():
+    """Small cnn student reproducing EMBEDDING_LAYER_NAME output of the teacher.
+
+    Same conv stack as create_architecture_small_cnn, with input rescaling,
+    strided first conv and global pooling to keep it cheap on CPU, followed by
+    a relu embedding layer of the teacher's size.
+    """
+    model = Sequential()
+    model.add(
+        keras.layers.Rescaling(
+            1.0 / 255, name='student_rescaling', input_shape=(
+                EFFICIENTNET_IMAGE_SIZE, EFFICIENTNET_IMAGE_SIZE, 3)))
+    model.add(keras.layers.Conv2D(
+        32, (3, 3), strides=2, activation='relu', name='student_conv_1'))
+    model.add(keras.layers.MaxPooling2D((2, 2), name='student_pool_1'))
+    model.add(keras.layers.Conv2D(
+        64, (3, 3), activation='relu', name='student_conv_2'))
+    model.add(keras.layers.MaxPooling2D((2, 2), name='student_pool_2'))
+    model.add(keras.layers.Conv2D(
+        128, (3, 3), activation='relu', name='student_conv_3'))
+    model.add(GlobalAveragePooling2D(name='student_pool_3'))
+    model.add(Dense(256, activation='relu', name='student_dense'))
+    model.add(Dense(128, activation='relu', name=EMBEDDING_LAYER_NAME))
+    model.summary()
+    return model
+
+
 def create_architecture_regression():
     """Regression from scratch.."""
     model = Sequential()
@@ -240,7 +409,15 @@ def create_architecture():
     print(model.summary())
     return model
 
-def train_model(base_dir, collection_id, model, X_train, y_train):
+def load_checkpoint(base_dir, collection_id):
+    """Loads previously trained Keras model from base_dir/<collection_id>/tf_logs/model."""
+    model_path = base_dir + '/{}'.format(collection_id) + '/tf_logs/model'
+    print('Loading checkpoint from {}'.format(model_path))
+    return tf.keras.models.load_model(model_path)
+
+
+def train_model(base_dir, collection_id, model, X_train, y_train,
+                epochs=EPOCHS, lr=LR):
     """Fine tunes EfficientNet on a given collection with ground truth labels.
 
     Saves model checkpoint to base_dir/<collection_id>/tf_logs/model.
@@ -251,6 +428,8 @@ def train_model(base_dir, collection_id, model, X_train, y_train):
       model: Keras model
       X_train: np array with flattened pixels for entire collection e.g. [collection_length, 224 * 224]
       y_train: ground truth labels for entire collection e.g. [collection_length]
+      epochs: number of training epochs
+      lr: learning rate
 
     Returns:
       model: trained Keras model
@@ -261,35 +440,229 @@ def train_model(base_dir, collection_id, model, X_train, y_train):
     os.system('sudo chmod -R ugo+rwx {}'.format(tf_logs))
     # Compile model.
     model.compile(
-        optimizer=tf.keras.optimizers.Adam(learning_rate=LR),
+        optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
         loss=tf.keras.losses.CategoricalCrossentropy(),
         metrics=['accuracy'])
-    steps_per_epoch = len(y_train) // BATCH_SIZE
-    validation_steps = len(y_train) // BATCH_SIZE
+    steps_per_epoch = max(1, len(y_train) // BATCH_SIZE)
+    validation_steps = max(1, len(y_train) // BATCH_SIZE)
     callbacks_ = [tensorboard_callback(tf_logs, "model"),
                   model_checkpoint(tf_logs, "model.ckpt")]
     # Train model.
-    hist = model.fit(
-        x=X_train, y=y_train,
-        epochs=EPOCHS, steps_per_epoch=steps_per_epoch,
-        validation_data=(X_train, y_train), callbacks=callbacks_).history
+    with profiling.profile_stage(base_dir, collection_id, 'train'):
+        hist = model.fit(
+            x=X_train, y=y_train,
+            epochs=epochs, steps_per_epoch=steps_per_epoch,
+            validation_data=(X_train, y_train), callbacks=callbacks_).history
     model.save(tf_logs + '/model')
+    export_embedding_model(base_dir, collection_id, model)
     return model
 
 
+def export_embedding_model(base_dir, collection_id, model):
+    """Exports inference-only model truncated at the embedding layer.
+
+    Drops the softmax head and optimizer state and freezes all weights so that
+    scoring loads a smaller artifact than the full training checkpoint.
+    Saves to base_dir/<collection_id>/tf_logs/embedding_model.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      model: trained Keras model containing EMBEDDING_LAYER_NAME
+
+    Returns:
+      embedding_model: Keras model with output of EMBEDDING_LAYER_NAME.
+    """
+    model_path = base_dir + '/{}'.format(collection_id) + '/tf_logs/embedding_model'
+    embedding_model = keras.models.Model(
+        inputs=model.input,
+        outputs=model.get_layer(EMBEDDING_LAYER_NAME).output)
+    embedding_model.trainable = False
+    embedding_model.save(model_path, include_optimizer=False)
+    print('Saving embedding model to {}'.format(model_path))
+    return embedding_model
+
+
+def load_teacher(base_dir, collection_id):
+    """Loads trained model truncated at EMBEDDING_LAYER_NAME."""
+    tf_logs = base_dir + '/{}'.format(collection_id) + '/tf_logs'
+    if os.path.exists(tf_logs + '/embedding_model'):
+        print('Loading teacher from {}'.format(tf_logs + '/embedding_model'))
+        return tf.keras.models.load_model(
+            tf_logs + '/embedding_model', compile=False)
+    model = load_checkpoint(base_dir, collection_id)
+    return keras.models.Model(
+        inputs=model.input,
+        outputs=model.get_layer(EMBEDDING_LAYER_NAME).output)
+
+
+def pixel_scores(X_train):
+    """Unscaled PixelScores from layer output, same binning as main.py."""
+    est = KBinsDiscretizer(
+        n_bins=PIXEL_SCORE_BINS,
+        encode='ordinal',
+        strategy='kmeans')
+    return np.mean(est.fit_transform(X_train), axis=1)
+
+
+def images_per_second(model, X_train, batch_size=BATCH_SIZE):
+    """Times model.predict on X_train after a warm-up batch."""
+    model.predict(X_train[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    model.predict(X_train, batch_size=batch_size)
+    return len(X_train) / (time.perf_counter() - start)
+
+
+def split_holdout_frames(n_frames, holdout):
+    """Randomly splits unique images into train and held-out rows of X_train."""
+    frames = np.random.permutation(n_frames)
+    n_holdout = max(PIXEL_SCORE_BINS, int(n_frames * holdout))
+    if n_holdout >= n_frames:
+        raise ValueError(
+            'Collection has {} unique images, too few to hold out {} for evaluation.'.format(
+                n_frames, n_holdout))
+    return np.sort(frames[n_holdout:]), np.sort(frames[:n_holdout])
+
+
+def evaluate_student(teacher, student, X_train, y_teacher, frame_index,
+                     holdout_frames, predict_batch_size=BATCH_SIZE):
+    """Compares student against teacher on images held out from distillation.
+
+    Args:
+      teacher: Keras model with teacher embeddings output
+      student: Keras model with student embeddings output
+      X_train: np array with pixels of unique images
+      y_teacher: np array with teacher embeddings of unique images [n_unique, 128]
+      frame_index: np array with row of X_train for each id
+      holdout_frames: np array with rows of X_train the student was not fitted on
+      predict_batch_size: batch size for inference
+
+    Returns:
+      report: dict with images per second of both models, speed-up, embedding
+        mse and Spearman rank correlation of PixelScores on held-out ids.
+    """
+    y_student = student.predict(
+        X_train[holdout_frames], batch_size=predict_batch_size)
+    y_teacher = y_teacher[holdout_frames]
+    # Ids whose image was held out, as rows of the held-out embeddings.
+    holdout_index = np.searchsorted(
+        holdout_frames, frame_index[np.isin(frame_index, holdout_frames)])
+    agreement = spearmanr(
+        pixel_scores(y_teacher[holdout_index]),
+        pixel_scores(y_student[holdout_index]))[0]
+    X_eval = X_train[:EVAL_TIMING_EXAMPLES]
+    teacher_ips = images_per_second(teacher, X_eval, predict_batch_size)
+    student_ips = images_per_second(student, X_eval, predict_batch_size)
+    report = {
+        'n_examples': int(len(frame_index)),
+        'n_holdout_examples': int(len(holdout_index)),
+        'teacher_images_per_second': teacher_ips,
+        'student_images_per_second': student_ips,
+        'speedup': student_ips / teacher_ips,
+        'embedding_mse': float(np.mean((y_teacher - y_student) ** 2)),
+        'rank_agreement': float(agreement),
+    }
+    print('Student evaluation: {}'.format(report))
+    return report
+
+
+def distill(base_dir, collection_id, X_train, frame_index,
+            predict_batch_size=BATCH_SIZE):
+    """Trains student to reproduce teacher embeddings and evaluates it.
+
+    Saves student to base_dir/<collection_id>/tf_logs/student_model and the
+    evaluation report to base_dir/<collection_id>/tf_logs/student_report.json.
+    DISTILL_HOLDOUT of the unique images are not used for fitting, rank
+    agreement is measured on the ids showing them.
+
+    Args:
+      base_dir: Base data directory on the current vm e.g. /mnt/disks/ssd/data
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      X_train: np array with pixels of unique images
+      frame_index: np array with row of X_train for each id
+      predict_batch_size: batch size for inference
+
+    Returns:
+      report: dict from evaluate_student
+    """
+    tf_logs = base_dir + '/{}'.format(collection_id) + '/tf_logs'
+    teacher = load_teacher(base_dir, collection_id)
+    print('Computing teacher embeddings.')
+    y_teacher = teacher.predict(X_train, batch_size=predict_batch_size)
+    train_frames, holdout_frames = split_holdout_frames(
+        len(X_train), DISTILL_HOLDOUT)
+    student = create_architecture_student()
+    student.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=DISTILL_LR),
+        loss=tf.keras.losses.MeanSquaredError())
+    with profiling.profile_stage(base_dir, collection_id, 'train'):
+        student.fit(
+            x=X_train[train_frames], y=y_teacher[train_frames],
+            batch_size=BATCH_SIZE,
+            epochs=DISTILL_EPOCHS,
+            callbacks=[tensorboard_callback(tf_logs, "student_model")])
+    student.save(tf_logs + '/student_model', include_optimizer=False)
+    print('Saving student model to {}'.format(tf_logs + '/student_model'))
+    report = evaluate_student(
+        teacher, student, X_train, y_teacher, frame_index, holdout_frames,
+        predict_batch_size)
+    # Lets main.py reject the student once the teacher is retrained.
+    report['teacher_mtime'] = model_version.teacher_mtime(tf_logs)
+    with open('student_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    file_utils.move_into_place(
+        'student_report.json', tf_logs + '/student_report.json')
+    return report
+
+
 def main(argv):
     if FLAGS.collection_id is not None:
         print('Training model for collection {}'.format(FLAGS.collection_id))
-    model = create_architecture()
+    # Thread settings from calibrate.py, batch size only applies to inference.
+    predict_batch_size = host_profile.apply_host_profile(FLAGS.base_dir)
     X_train, ids = load_collection_numpy(FLAGS.base_dir, FLAGS.collection_id)
+    frame_index = load_frame_index(FLAGS.base_dir, FLAGS.collection_id, len(ids))
+    if FLAGS.distill:
+        distill(FLAGS.base_dir, FLAGS.collection_id, X_train, frame_index,
+                predict_batch_size or BATCH_SIZE)
+        print('Completed distillation for collection {}'.format(
+            FLAGS.collection_id))
+        print('Success')
+        return
     y_train = load_labels(FLAGS.base_dir, FLAGS.collection_id, ids)
     y_train_cat = tf.keras.utils.to_categorical(y_train)
-    trained_model = train_model(
-        FLAGS.base_dir,
-        FLAGS.collection_id,
-        model,
-        X_train,
-        y_train_cat)
+    trained_ids = None
+    if FLAGS.incremental:
+        trained_ids = load_trained_ids(FLAGS.base_dir, FLAGS.collection_id)
+        if trained_ids is None:
+            print('No checkpoint with trained ids found, running full training.')
+    if trained_ids is not None:
+        indices = select_incremental_examples(
+            ids, trained_ids, FLAGS.replay_ratio)
+        if len(indices) == 0:
+            print('No new tokens for collection {}, keeping checkpoint'.format(
+                FLAGS.collection_id))
+            print('Success')
+            return
+        model = load_checkpoint(FLAGS.base_dir, FLAGS.collection_id)
+        trained_model = train_model(
+            FLAGS.base_dir,
+            FLAGS.collection_id,
+            model,
+            X_train[frame_index[indices]],
+            y_train_cat[indices],
+            epochs=FLAGS.incremental_epochs,
+            lr=INCREMENTAL_LR)
+        ids = np.union1d(trained_ids, ids)
+    else:
+        model = create_architecture()
+        trained_model = train_model(
+            FLAGS.base_dir,
+            FLAGS.collection_id,
+            model,
+            X_train[frame_index],
+            y_train_cat)
+    save_trained_ids(FLAGS.base_dir, FLAGS.collection_id, ids)
     print(
         'Completed model training for collection {}'.format(
             FLAGS.collection_id))
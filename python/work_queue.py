@@ -0,0 +1,152 @@
+"""File-based work queue for running batch scripts on several nodes.
+
+Nodes that mount the same base_dir coordinate through files in
+base_dir/.work_queue/<run_id>, no external service is needed. A unit of work
+is one stage of one collection, e.g. ('0xbc4c...', 'train_model'). Markers
+are scoped to the run, a refresh run with a new run_id starts from scratch
+and retries units that failed in earlier runs.
+
+<unit>.lease - claimed by a node, created atomically with O_CREAT | O_EXCL
+  and holding its node_id. The node touches the file every heartbeat interval
+  while it works and releases the unit only if the lease still holds its id. A lease
+  whose mtime is older than lease_ttl belongs to a dead node and is reclaimed
+  by renaming it away, which only one node can do.
+<unit>.done - stage completed successfully.
+<unit>.failed - stage exited with an error, not retried.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+
+QUEUE_DIR = '.work_queue'
+
+
+def queue_dir(base_dir, run_id):
+    """Returns work queue directory of the run under base_dir, creating it if needed."""
+    path = base_dir + '/{}/{}'.format(QUEUE_DIR, run_id)
+    if not os.path.exists(path):
+        os.system('sudo mkdir -p {}'.format(path))
+        os.system('sudo chmod ugo+rwx {}'.format(path))
+    return path
+
+
+def default_node_id():
+    """Returns id unique to this process on this host."""
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def unit_path(queue, collection_id, stage, suffix):
+    """Returns path of lease or marker file of the unit."""
+    return queue + '/{}.{}.{}'.format(collection_id, stage, suffix)
+
+
+def is_done(queue, collection_id, stage):
+    """Returns True if unit completed successfully."""
+    return os.path.exists(unit_path(queue, collection_id, stage, 'done'))
+
+
+def is_failed(queue, collection_id, stage):
+    """Returns True if unit exited with an error."""
+    return os.path.exists(unit_path(queue, collection_id, stage, 'failed'))
+
+
+def try_acquire(queue, collection_id, stage, node_id, lease_ttl):
+    """Tries to claim the unit for node_id.
+
+    Args:
+      queue: work queue directory of the run, see queue_dir
+      collection_id: collection address e.g. '0xbc4ca0eda7647a8ab7c2061c2e118a18a936f13d'
+      stage: name of pipeline stage e.g. 'train_model'
+      node_id: id of the claiming node
+      lease_ttl: seconds without heartbeat after which a lease is expired
+
+    Returns:
+      path to the lease file if claimed, None otherwise.
+    """
+    lease = unit_path(queue, collection_id, stage, 'lease')
+    try:
+        age = time.time() - os.path.getmtime(lease)
+        if age < lease_ttl:
+            return None
+        # Expired lease of a dead node, only one node succeeds to rename it.
+        stale = '{}.stale.{}'.format(lease, node_id)
+        os.rename(lease, stale)
+        if time.time() - os.path.getmtime(stale) < lease_ttl:
+            # Another node reclaimed and re-leased it in between, give it back.
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return None
+        os.remove(stale)
+        print('Reclaimed expired lease {}'.format(lease))
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'node_id': node_id, 'acquired': time.time()}, f)
+    return lease
+
+
+def lease_owner(lease):
+    """Returns node_id stored in the lease, None if it is missing or being written."""
+    try:
+        with open(lease) as f:
+            return json.load(f)['node_id']
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def release(lease, queue, collection_id, stage, node_id, success):
+    """Marks unit as done or failed and removes the lease.
+
+    Does nothing if the lease was reclaimed by another node in the meantime,
+    the unit then belongs to that node.
+
+    Returns:
+      True if the unit was still leased by node_id.
+    """
+    if lease_owner(lease) != node_id:
+        print('Lease {} no longer held by {}, not releasing'.format(
+            lease, node_id))
+        return False
+    marker = unit_path(
+        queue, collection_id, stage, 'done' if success else 'failed')
+    with open(marker, 'w') as f:
+        f.write(node_id)
+    try:
+        os.remove(lease)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def start_heartbeat(lease, node_id, interval):
+    """Touches lease every interval seconds until the returned event is set.
+
+    The lease can be missing for a moment while another node checks whether
+    it expired, the heartbeat retries then. It only stops once the lease holds
+    another node_id.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            owner = lease_owner(lease)
+            if owner is not None and owner != node_id:
+                print('Lease {} taken over by {}'.format(lease, owner))
+                return
+            try:
+                os.utime(lease)
+            except FileNotFoundError:
+                pass
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop